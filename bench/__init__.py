@@ -0,0 +1 @@
+"""Нагрузочные тесты бота на локальной замене Bot API (см. python -m bench --help)."""
@@ -0,0 +1,198 @@
+"""Нагрузочный прогон бота без сети.
+
+Поднимает bench.fake_api в отдельном процессе, направляет бота на него через
+TELEGRAM_API_URL и прогоняет сгенерированные сессии через dp.feed_update.
+Печатает updates/s, p50/p95/p99 времени обработки апдейта, число вызовов
+Bot API на апдейт и пиковый RSS процесса бота.
+
+    python -m bench --users 500 --concurrency 50 --latency-ms 20
+    python -m bench --json > baseline.json
+    python -m bench --baseline baseline.json --max-regression 0.15
+
+Переменные окружения бота (CART_RENDER_DELAY, STORAGE и т.д.) действуют как обычно.
+Лимиты частоты отправки по умолчанию сняты, чтобы мерить сам бот; --rate-limits
+оставляет настройки SEND_* как есть.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from bench import fake_api, workload
+
+
+def _wait_port(host: str, port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex((host, port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"Fake Bot API did not start on {host}:{port}")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def configure_env(api_url: str, workdir: str, rate_limits: bool):
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ.setdefault("TG_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ.setdefault("STORAGE", "memory")
+    os.environ.setdefault("ORDERS_PATH", os.path.join(workdir, "orders.jsonl"))
+    os.environ.setdefault("PHOTO_CACHE_PATH", os.path.join(workdir, "photo_cache.json"))
+    if not rate_limits:
+        for name in ("SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+            os.environ[name] = "1e9"
+        os.environ.setdefault("SEND_QUEUE_SIZE", "1000000")
+
+
+async def _api(api_url: str, method: str, path: str) -> Dict:
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, f"{api_url}{path}") as resp:
+            return await resp.json()
+
+
+async def run(args, api_url: str) -> Dict:
+    import bot as app
+    from aiogram.types import Update
+
+    # Строка лога на каждый апдейт заметно искажает замер
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    await app.dp.emit_startup(bot=app.bot)
+    update_id = 0
+
+    async def play(sessions, latencies):
+        nonlocal update_id
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def one(session):
+            nonlocal update_id
+            async with sem:
+                for raw in session.updates:
+                    update_id += 1
+                    update = Update.model_validate({"update_id": update_id, **raw}, context={"bot": app.bot})
+                    start = time.perf_counter()
+                    await app.dp.feed_update(app.bot, update)
+                    latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(one(s) for s in sessions))
+
+    index = app.catalog_index
+    if args.warmup:
+        await play(workload.generate(index, args.warmup, seed=args.seed + 1, first_uid=1), [])
+    await _api(api_url, "POST", "/_reset")
+
+    sessions = workload.generate(index, args.users, seed=args.seed)
+    latencies: List[float] = []
+    started = time.perf_counter()
+    await play(sessions, latencies)
+    elapsed = time.perf_counter() - started
+
+    stats = await _api(api_url, "GET", "/_stats")
+    await app.dp.emit_shutdown(bot=app.bot)
+    await app.bot.session.close()
+
+    latencies.sort()
+    updates = len(latencies)
+    api_calls = sum(stats["calls"].values())
+    return {
+        "users": args.users,
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "api_calls": api_calls,
+        "api_calls_per_update": round(api_calls / updates, 3),
+        "api_calls_by_method": stats["calls"],
+        "api_floods": stats["floods"],
+        # ru_maxrss в Linux — в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(result: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    failures = []
+    if result["updates_per_s"] < baseline["updates_per_s"] * (1 - max_regression):
+        failures.append(f"updates/s {result['updates_per_s']} < baseline {baseline['updates_per_s']}")
+    for key in ("p95_ms", "p99_ms", "api_calls_per_update"):
+        if result[key] > baseline[key] * (1 + max_regression):
+            failures.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20, help="пользователей в разогреве (не входят в отчёт)")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно активных пользователей")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--api-url", help="уже запущенный bench.fake_api вместо собственного")
+    parser.add_argument("--rate-limits", action="store_true", help="не снимать ограничения SEND_*")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = None
+    api_url = args.api_url
+    if not api_url:
+        port = _free_port()
+        server = multiprocessing.Process(target=fake_api.serve, args=("127.0.0.1", port), kwargs={
+            "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "flood_rate": args.flood_rate,
+            "seed": args.seed,
+        }, daemon=True)
+        server.start()
+        _wait_port("127.0.0.1", port)
+        api_url = f"http://127.0.0.1:{port}"
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configure_env(api_url, workdir, args.rate_limits)
+            result = asyncio.run(run(args, api_url))
+    finally:
+        if server:
+            server.terminate()
+            server.join()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:>22}: {value}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures = compare(result, json.load(f), args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION: {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
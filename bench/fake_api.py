@@ -0,0 +1,112 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот, правдоподобными объектами, считает
+вызовы, добавляет задержку и с заданной вероятностью отвечает 429.
+
+    python -m bench.fake_api --port 8081 --latency-ms 30 --flood-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "editMessageText", "editMessageCaption",
+    "editMessageMedia", "editMessageReplyMarkup",
+}
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.floods: Counter = Counter()
+        self.next_message_id = 1
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_post("/_reset", self.handle_reset)
+        return app
+
+    def _message(self, params) -> dict:
+        message_id = int(params.get("message_id") or 0)
+        if not message_id:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "photo" in params:
+            file_id = f"fake-{abs(hash(params['photo'])) % 10 ** 12}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 800}]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        return message
+
+    def _result(self, method: str, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in MESSAGE_METHODS:
+            # Редактирование inline-сообщения возвращает True
+            return True if params.get("inline_message_id") else self._message(params)
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.floods[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(self.calls), "floods": dict(self.floods)})
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.calls.clear()
+        self.floods.clear()
+        return web.json_response({"ok": True})
+
+
+def serve(host: str, port: int, **options):
+    web.run_app(FakeBotAPI(**options).app(), host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(vars(args)))
+    serve(args.host, args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+          flood_rate=args.flood_rate, retry_after=args.retry_after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Генератор реалистичных потоков апдейтов: просмотр каталога, добавление в корзину,
+серии нажатий ➕/➖, оформление заказа с отправкой контакта, поиск."""
+import random
+from typing import Dict, List
+
+import callbacks as cbd
+
+Update = Dict
+
+
+class Session:
+    """Апдейты одного пользователя в порядке отправки."""
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.updates: List[Update] = []
+        self.message_id = 0
+
+    def _user(self) -> dict:
+        return {"id": self.uid, "is_bot": False, "first_name": f"user{self.uid}", "language_code": "ru"}
+
+    def _message(self, **fields) -> dict:
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": 0, "chat": {"id": self.uid, "type": "private"},
+                "from": self._user(), **fields}
+
+    def text(self, text: str):
+        self.updates.append({"message": self._message(text=text)})
+
+    def contact(self, phone: str):
+        self.updates.append({"message": self._message(contact={"phone_number": phone, "first_name": "u", "user_id": self.uid})})
+
+    def tap(self, data: str, message_id: int = 0):
+        # Кнопка нажата в сообщении бота; для корзины — всегда в одном и том же сообщении
+        message = {"message_id": message_id or self.message_id, "date": 0,
+                   "chat": {"id": self.uid, "type": "private"}, "text": "…"}
+        self.updates.append({"callback_query": {
+            "id": f"{self.uid}-{len(self.updates)}", "from": self._user(), "chat_instance": str(self.uid),
+            "data": data, "message": message,
+        }})
+
+    def inline(self, query: str):
+        self.updates.append({"inline_query": {
+            "id": f"{self.uid}-{len(self.updates)}", "from": self._user(), "query": query, "offset": "",
+        }})
+
+
+SEARCH_QUERIES = ("сыворотка", "крем", "маска", "гиалурон", "сывортка", "мочевина", "алоэ", "крем для лица")
+CART_MESSAGE_ID = 10 ** 6
+
+
+def generate(index, users: int = 200, seed: int = 0, first_uid: int = 10 ** 6) -> List[Session]:
+    """Строит сессии для users пользователей по снимку каталога index (bot.catalog_index)."""
+    rnd = random.Random(seed)
+    categories = list(index.catalog)
+    sessions = []
+    for n in range(users):
+        s = Session(first_uid + n)
+        s.text("/start")
+        s.text("🛍 Каталог")
+        viewed = []
+        for _ in range(rnd.randint(1, 3)):
+            cat_name = rnd.choice(categories)
+            s.tap(cbd.encode(cbd.CATEGORY, index.category_codes[cat_name]))
+            for item in rnd.sample(index.catalog[cat_name], min(len(index.catalog[cat_name]), rnd.randint(1, 3))):
+                s.tap(cbd.encode(cbd.PRODUCT, item["id"]))
+                viewed.append(item["id"])
+            s.tap(cbd.encode(cbd.BACK_CATEGORIES))
+        if rnd.random() < 0.15:
+            s.inline(rnd.choice(SEARCH_QUERIES))
+        if rnd.random() < 0.1:
+            s.text(f"/search {rnd.choice(SEARCH_QUERIES)}")
+        if rnd.random() < 0.6:
+            in_cart = rnd.sample(viewed, min(len(viewed), rnd.randint(1, 3)))
+            for pid in in_cart:
+                s.tap(cbd.encode(cbd.ADD, pid))
+            s.text("🛒 Корзина")
+            if rnd.random() < 0.7:
+                for _ in range(rnd.randint(3, 8)):
+                    code = cbd.CART_INC if rnd.random() < 0.65 else cbd.CART_DEC
+                    s.tap(cbd.encode(code, rnd.choice(in_cart)), CART_MESSAGE_ID)
+            if rnd.random() < 0.5:
+                s.tap(cbd.encode(cbd.CHECKOUT), CART_MESSAGE_ID)
+                s.contact(f"+7900{s.uid % 10 ** 7:07d}")
+        sessions.append(s)
+    return sessions
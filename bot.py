@@ -1,40 +1,149 @@
 import asyncio
+import functools
+from collections import OrderedDict
+from contextvars import ContextVar
+import json
 import os
-from typing import Dict, List, Optional, Tuple
+import time
+import uuid
+from datetime import timedelta
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton
+    InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent, InputMediaPhoto
 )
 import logging
 
+import callbacks as cbd
+from dedup import CheckoutTokens, RecentIds
+from http_session import TunedSession, parse_method_timeouts
+from catalog_source import CatalogError, CatalogWatcher, load_catalog, parse_price_to_int
+from callbacks import CallbackAction
+from journal import OrderJournal
+from metrics import ApiMetricsMiddleware, Metrics
+from navigation import Navigator, View
+from reports import OrderDigest, SalesAggregator
+from pricing import DEFAULT_TIERS, Pricing, Quote, load_partner_prices, parse_tiers
+from search import SearchIndex, same_text
+from scheduler import BROWSE, ORDER, SchedulerMiddleware, SendScheduler, send_priority
+from storage import create_storage
+
 logging.basicConfig(level=logging.INFO)
 
 # ==================== Env ====================
 load_dotenv()
 API_TOKEN = os.getenv("TG_TOKEN")
+# Адрес Bot API (например, локальный telegram-bot-api или тестовый стенд); пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 ADMIN_ID = int(os.getenv("ADMIN_ID")) if os.getenv("ADMIN_ID") and os.getenv("ADMIN_ID").isdigit() else None
+PHOTO_CACHE_PATH = os.getenv("PHOTO_CACHE_PATH", "photo_cache.json")
+# Хранилище корзин: memory или sqlite
+STORAGE = os.getenv("STORAGE", "memory")
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot.db")
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "0.5"))
+# Предел пользователей с корзиной в памяти и срок, после которого брошенная корзина удаляется (0 — без ограничений)
+CART_MAX_USERS = int(os.getenv("CART_MAX_USERS", "20000"))
+CART_TTL = float(os.getenv("CART_TTL", str(3 * 24 * 3600)))
+# Сообщать администратору о корзинах, удалённых по сроку или из-за переполнения
+ABANDONED_CART_NOTIFY_ADMIN = os.getenv("ABANDONED_CART_NOTIFY_ADMIN", "").lower() in ("1", "true", "yes")
+# Оптовые скидки "порог:процент,..." и JSON с персональными ценами партнёров {"<user_id>": {"<product_id>": цена}}
+WHOLESALE_TIERS = os.getenv("WHOLESALE_TIERS")
+PARTNER_PRICES_PATH = os.getenv("PARTNER_PRICES_PATH")
+ORDERS_PATH = os.getenv("ORDERS_PATH", "orders.jsonl")
+ORDERS_FSYNC_INTERVAL = float(os.getenv("ORDERS_FSYNC_INTERVAL", "1.0"))
+# Окно защиты от повторной доставки апдейтов: сколько секунд и сколько update_id помнить
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "3600"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "50000"))
+# Отчёты /report: файл с агрегатами и позицией в журнале, часовой пояс дат (часы от UTC)
+REPORT_CHECKPOINT_PATH = os.getenv("REPORT_CHECKPOINT_PATH", "sales_checkpoint.json")
+REPORT_UTC_OFFSET = float(os.getenv("REPORT_UTC_OFFSET", "3"))
+# Раз в сколько секунд присылать администратору сводку новых заказов (0 — сообщение на каждый заказ)
+ORDER_DIGEST_INTERVAL = float(os.getenv("ORDER_DIGEST_INTERVAL", "0"))
+# HTTP-сессия Bot API: размер пула соединений, keep-alive и кэш DNS (секунды), таймауты (секунды)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "256"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+# Таймауты отдельных методов "метод:секунды,..."; загрузка фото дольше, ответ на нажатие бесполезен через 15 с
+HTTP_METHOD_TIMEOUTS = parse_method_timeouts(os.getenv(
+    "HTTP_METHOD_TIMEOUTS", "sendPhoto:60,editMessageMedia:60,answerCallbackQuery:10,answerInlineQuery:10"))
+# Сколько соединений пула могут одновременно занять загрузки фото (0 — без ограничения)
+HTTP_MEDIA_CONCURRENCY = int(os.getenv("HTTP_MEDIA_CONCURRENCY", str(HTTP_POOL_SIZE // 2)))
+# Ограничения частоты отправки (Telegram: ~30 сообщений/с на бота, ~1/с в чат)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "1000"))
+# Окно, за которое быстрые нажатия ➕/➖ сливаются в одно обновление корзины (0 — без задержки; в облачной функции по умолчанию 0)
+CART_RENDER_DELAY = float(os.getenv("CART_RENDER_DELAY", "0.4"))
+# Внешний источник каталога (json/csv/sqlite:<путь>); пусто — встроенный каталог ниже
+CATALOG_SOURCE = os.getenv("CATALOG_SOURCE")
+CATALOG_POLL_INTERVAL = float(os.getenv("CATALOG_POLL_INTERVAL", "5"))
+# Метрики: отдельный порт для /metrics в polling-режиме (в webhook-режиме — тот же сервер) и период сводки в логе
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "0"))
+# Навигация по каталогу: edit — правка сообщения на месте, send — новое сообщение на каждый шаг
+NAVIGATION = os.getenv("NAVIGATION", "edit")
+# Режим работы: polling (по умолчанию), webhook или cluster (webhook-вход и несколько процессов-воркеров)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://example.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+# Режим cluster: число воркеров за webhook-входом и их внутренние порты (WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...)
+WORKERS = int(os.getenv("WORKERS") or os.cpu_count() or 1)
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", str(WEBAPP_PORT + 1)))
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+# Задаются процессу воркера самим cluster-режимом
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_PORT = int(os.getenv("WORKER_PORT", "0"))
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "20"))
+# Чат для предзагрузки фото при старте (пусто — не прогревать)
+PHOTO_WARMUP_CHAT_ID = int(os.getenv("PHOTO_WARMUP_CHAT_ID")) if os.getenv("PHOTO_WARMUP_CHAT_ID", "").lstrip("-").isdigit() else None
+
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_QUEUE_SIZE)
+metrics = Metrics()
 
-bot = Bot(token=API_TOKEN)
+def create_session() -> TunedSession:
+    """Сессия Bot API со всеми middleware; любая замена bot.session должна идти через неё."""
+    session = TunedSession(
+        pool_size=HTTP_POOL_SIZE, keepalive=HTTP_KEEPALIVE, dns_ttl=HTTP_DNS_TTL,
+        connect_timeout=HTTP_CONNECT_TIMEOUT, method_timeouts=HTTP_METHOD_TIMEOUTS,
+        media_concurrency=HTTP_MEDIA_CONCURRENCY, timeout=HTTP_TIMEOUT,
+        api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION,
+    )
+    session.middleware(SchedulerMiddleware(send_scheduler, alert_chat_id=ADMIN_ID))
+    # Регистрируется после планировщика, поэтому меряет только сам запрос, без ожидания в очереди
+    session.middleware(ApiMetricsMiddleware(metrics))
+    return session
+
+bot = Bot(token=API_TOKEN, session=create_session())
 dp = Dispatcher()
 router = Router()
 
+recent_updates = RecentIds(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL)
+
+@dp.update.outer_middleware()
+async def drop_duplicate_updates(handler, event, data):
+    # Регистрируется первым: повтор отбрасывается до любой обработки
+    if recent_updates.seen(event.update_id):
+        logging.info(f"Duplicate update {event.update_id} skipped")
+        return None
+    return await handler(event, data)
+
 # ==================== Catalog ====================
 Product = Dict[str, str]
 Catalog = Dict[str, List[Product]]
 
-def parse_price_to_int(price: str) -> int:
-    s = price.replace("₽", "").replace("р.", "").replace("руб.", "").replace(" ", "").replace("\u00A0", "").strip()
-    return int(s) if s else 0
-
-def find_product_by_id(cat: Catalog, pid: str) -> Optional[Product]:
-    for items in cat.values():
-        for it in items:
-            if it["id"] == pid:
-                return it
-    return None
-
 catalog: Catalog = {
  "Очищение": [
         {
@@ -254,6 +363,204 @@ catalog: Catalog = {
     ],
 }
 
+class CatalogIndex(NamedTuple):
+    """Неизменяемый снимок каталога со всеми производными структурами.
+
+    Перезагрузка каталога строит новый снимок целиком и подменяет ссылку на него,
+    поэтому обработчик, взявший снимок в начале апдейта, видит согласованные данные.
+    """
+    catalog: Catalog
+    version: int
+    products: Mapping[str, Product]   # id -> товар
+    categories: Mapping[str, str]     # id -> категория
+    prices: Mapping[str, int]         # id -> цена в рублях
+    # Коды категорий для callback_data (см. callbacks.category_code) и обратно
+    category_codes: Mapping[str, str]
+    category_by_code: Mapping[str, str]
+    # Структура, от которой зависят клавиатуры навигации: категории, id и названия товаров
+    layout: tuple
+    keyboards: Dict[tuple, InlineKeyboardMarkup]
+    search: SearchIndex
+
+def build_catalog_index(cat: Catalog, previous: Optional[CatalogIndex] = None) -> CatalogIndex:
+    """Строит снимок каталога; неизменившиеся товары и цены переиспользуются из previous."""
+    prev_products = previous.products if previous else {}
+    products, categories, prices = {}, {}, {}
+    # Поисковый индекс переносится, если ни у одного товара не поменялись название, описание или объём
+    search_changed = previous is None
+    for cat_name, items in cat.items():
+        for it in items:
+            pid = it["id"]
+            old = prev_products.get(pid)
+            if old is not None and old == it:
+                products[pid], prices[pid] = old, previous.prices[pid]
+            else:
+                products[pid] = MappingProxyType(dict(it))
+                prices[pid] = parse_price_to_int(it["price"])
+                search_changed = search_changed or old is None or not same_text(old, it)
+            categories[pid] = cat_name
+    search_changed = search_changed or len(products) != len(prev_products)
+    category_codes = {name: cbd.category_code(name) for name in cat}
+    layout = tuple((name, tuple((it["id"], it["name"]) for it in items)) for name, items in cat.items())
+    # Клавиатуры переносятся, только если навигация не поменялась (например, изменилась лишь цена)
+    keyboards = dict(previous.keyboards) if previous and previous.layout == layout else {}
+    return CatalogIndex(
+        cat, previous.version + 1 if previous else 0,
+        MappingProxyType(products), MappingProxyType(categories), MappingProxyType(prices),
+        MappingProxyType(category_codes), MappingProxyType({code: name for name, code in category_codes.items()}),
+        layout, keyboards, SearchIndex(products) if search_changed else previous.search,
+    )
+
+if CATALOG_SOURCE:
+    try:
+        catalog = load_catalog(CATALOG_SOURCE)
+    except (OSError, ValueError, CatalogError) as e:
+        logging.error(f"Failed to load catalog from {CATALOG_SOURCE}, using built-in catalog: {e}")
+
+catalog_index = build_catalog_index(catalog)
+# Снимок, закреплённый за текущим апдейтом (см. CatalogSnapshotMiddleware)
+active_catalog: ContextVar[Optional[CatalogIndex]] = ContextVar("active_catalog", default=None)
+
+def current_catalog() -> CatalogIndex:
+    return active_catalog.get() or catalog_index
+
+def category_of(code: Optional[str]) -> Optional[str]:
+    return current_catalog().category_by_code.get(code)
+
+def product_of(pid: Optional[str]) -> Optional[str]:
+    return pid if pid in current_catalog().products else None
+
+@dp.update.outer_middleware()
+async def pin_catalog_snapshot(handler, event, data):
+    # Весь апдейт обрабатывается на одном снимке каталога, даже если он перезагрузится посреди обработки
+    token = active_catalog.set(catalog_index)
+    try:
+        return await handler(event, data)
+    finally:
+        active_catalog.reset(token)
+
+# ==================== Photo cache ====================
+class PhotoCache:
+    """Telegram file_id загруженных фото: {product_id: {"url": ..., "file_id": ...}}.
+
+    Изменения только помечают кэш; файл переписывается раз в save_interval секунд
+    в пуле потоков и ещё раз при остановке.
+    """
+
+    def __init__(self, path: str, save_interval: float = 5):
+        self.path = path
+        self.save_interval = save_interval
+        self.entries: Dict[str, Dict[str, str]] = {}
+        self.dirty = False
+        self.lock: Optional[asyncio.Lock] = None
+        self.task: Optional[asyncio.Task] = None
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Photo cache {path} is unreadable, starting empty: {e}")
+
+    def get(self, pid: str, url: str) -> Optional[str]:
+        entry = self.entries.get(pid)
+        if not entry: return None
+        if entry["url"] != url:
+            # Ссылка на фото поменялась — старый file_id больше не актуален
+            self.drop(pid)
+            return None
+        return entry["file_id"]
+
+    def put(self, pid: str, url: str, file_id: str):
+        self.entries[pid] = {"url": url, "file_id": file_id}
+        self.dirty = True
+
+    def drop(self, pid: str):
+        if self.entries.pop(pid, None) is not None:
+            self.dirty = True
+
+    def _save(self, state: str):
+        # У каждого процесса свой временный файл: в режиме cluster кэш сохраняют несколько воркеров
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(state)
+        os.replace(tmp, self.path)
+
+    async def flush(self):
+        if not self.dirty: return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.dirty: return
+            state = json.dumps(self.entries, ensure_ascii=False)
+            self.dirty = False
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._save, state)
+            except OSError as e:
+                self.dirty = True
+                logging.warning(f"Failed to save photo cache {self.path}: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.flush()
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+photo_cache = PhotoCache(PHOTO_CACHE_PATH)
+
+async def _with_cached_photo(product: Product, send: Callable[[str], Awaitable[Message]]) -> Message:
+    pid, url = product["id"], product["photo"]
+    file_id = photo_cache.get(pid, url)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest as e:
+            # Ошибки про само сообщение (не найдено, не изменено) к file_id отношения не имеют
+            if "message" in str(e): raise
+            logging.warning(f"Cached file_id for {pid} rejected, re-uploading: {e}")
+            photo_cache.drop(pid)
+    msg = await send(url)
+    if isinstance(msg, Message) and msg.photo:
+        photo_cache.put(pid, url, msg.photo[-1].file_id)
+    return msg
+
+async def send_product_photo(chat_id: int, product: Product, **kwargs) -> Message:
+    return await _with_cached_photo(product, lambda photo: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs))
+
+async def edit_product_photo(chat_id: int, message_id: int, product: Product, caption: str,
+                             reply_markup: InlineKeyboardMarkup) -> Message:
+    return await _with_cached_photo(product, lambda photo: bot.edit_message_media(
+        media=InputMediaPhoto(media=photo, caption=caption),
+        chat_id=chat_id, message_id=message_id, reply_markup=reply_markup,
+    ))
+
+async def warmup_photos(chat_id: int) -> int:
+    """Загружает в chat_id все фото каталога, которых ещё нет в кэше. Возвращает число загруженных."""
+    uploaded = 0
+    for pid, product in current_catalog().products.items():
+        if photo_cache.get(pid, product["photo"]): continue
+        try:
+            msg = await send_product_photo(chat_id, product, disable_notification=True)
+        except TelegramAPIError as e:
+            logging.warning(f"Photo warmup failed for {pid}: {e}")
+            continue
+        uploaded += 1
+        try:
+            await bot.delete_message(chat_id, msg.message_id)
+        except TelegramAPIError:
+            pass
+    logging.info(f"Photo warmup done: {uploaded} uploaded, {len(photo_cache.entries)} cached")
+    return uploaded
+
 # ==================== Keyboards ====================
 main_kb = ReplyKeyboardMarkup(
     keyboard=[
@@ -263,189 +570,571 @@ main_kb = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-def build_categories_keyboard() -> InlineKeyboardMarkup:
+def catalog_keyboard(builder):
+    """Кэширует клавиатуру, зависящую только от каталога, в снимке каталога.
+
+    Новый снимок получает пустой кэш, если изменилась навигация, поэтому
+    отдельной инвалидации не требуется.
+    """
+    @functools.wraps(builder)
+    def wrapper(*args) -> InlineKeyboardMarkup:
+        index = current_catalog()
+        key = (builder.__name__,) + args
+        kb = index.keyboards.get(key)
+        if kb is None:
+            kb = index.keyboards[key] = builder(index, *args)
+        return kb
+    wrapper.build = builder
+    return wrapper
+
+@catalog_keyboard
+def build_categories_keyboard(index: CatalogIndex) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=cat, callback_data=f"category:{cat}")] for cat in catalog.keys()
+            [InlineKeyboardButton(text=cat, callback_data=cbd.encode(cbd.CATEGORY, index.category_codes[cat]))]
+            for cat in index.catalog
         ]
     )
 
-def build_products_keyboard(cat_name: str) -> InlineKeyboardMarkup:
-    kb = [[InlineKeyboardButton(text=item["name"], callback_data=f"product:{item['id']}")] for item in catalog[cat_name]]
-    kb.append([InlineKeyboardButton(text="⬅️ К категориям", callback_data="back:categories")])
+@catalog_keyboard
+def build_products_keyboard(index: CatalogIndex, cat_name: str) -> InlineKeyboardMarkup:
+    kb = [[InlineKeyboardButton(text=item["name"], callback_data=cbd.encode(cbd.PRODUCT, item["id"]))] for item in index.catalog[cat_name]]
+    kb.append([InlineKeyboardButton(text="⬅️ К категориям", callback_data=cbd.encode(cbd.BACK_CATEGORIES))])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def build_product_keyboard(pid: str) -> InlineKeyboardMarkup:
+@catalog_keyboard
+def build_product_keyboard(index: CatalogIndex, pid: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ В корзину", callback_data=f"add:{pid}")],
-        [InlineKeyboardButton(text="⬅️ К товарам", callback_data=f"back:products:{pid}")]
+        [InlineKeyboardButton(text="➕ В корзину", callback_data=cbd.encode(cbd.ADD, pid))],
+        [InlineKeyboardButton(text="⬅️ К товарам", callback_data=cbd.encode(cbd.BACK_PRODUCTS, pid))]
     ])
 
+@catalog_keyboard
+def build_inline_product_keyboard(index: CatalogIndex, pid: str) -> InlineKeyboardMarkup:
+    # Сообщения из inline-режима живут в чужих чатах, навигация там не нужна
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ В корзину", callback_data=cbd.encode(cbd.ADD, pid))]
+    ])
+
+def product_keyboard_in_cart(pid: str, qty: int) -> InlineKeyboardMarkup:
+    """Клавиатура товара с количеством в корзине на кнопке добавления (не кэшируется)."""
+    rows = [list(row) for row in build_product_keyboard(pid).inline_keyboard]
+    rows[0][0] = InlineKeyboardButton(text=f"➕ В корзину · {qty} шт.", callback_data=rows[0][0].callback_data)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def prepare_catalog(cat: Catalog, previous: Optional[CatalogIndex]) -> CatalogIndex:
+    """Строит снимок и заранее собирает его клавиатуры навигации."""
+    index = build_catalog_index(cat, previous)
+    if ("build_categories_keyboard",) not in index.keyboards:
+        index.keyboards[("build_categories_keyboard",)] = build_categories_keyboard.build(index)
+    for cat_name in cat:
+        key = ("build_products_keyboard", cat_name)
+        if key not in index.keyboards:
+            index.keyboards[key] = build_products_keyboard.build(index, cat_name)
+    for pid in index.products:
+        key = ("build_product_keyboard", pid)
+        if key not in index.keyboards:
+            index.keyboards[key] = build_product_keyboard.build(index, pid)
+    return index
+
 def build_cart_keyboard(uid: int) -> InlineKeyboardMarkup:
-    items = carts.get(uid, [])
+    index = current_catalog()
+    items = storage.get_cart(uid)
     kb = []
-    for it in items:
-        name = find_product_by_id(catalog, it["id"])["name"][:18]
+    for pid, qty in items.items():
+        p = index.products.get(pid)
+        if not p: continue
+        name = p["name"][:18]
         kb.append([
-            InlineKeyboardButton(text=f"➖ {name}", callback_data=f"cart:dec:{it['id']}"),
-            InlineKeyboardButton(text=f"{it['qty']} шт.", callback_data="noop"),
-            InlineKeyboardButton(text="➕", callback_data=f"cart:inc:{it['id']}"),
-            InlineKeyboardButton(text="❌", callback_data=f"cart:del:{it['id']}")
+            InlineKeyboardButton(text=f"➖ {name}", callback_data=cbd.encode(cbd.CART_DEC, pid)),
+            InlineKeyboardButton(text=f"{qty} шт.", callback_data=cbd.encode(cbd.NOOP)),
+            InlineKeyboardButton(text="➕", callback_data=cbd.encode(cbd.CART_INC, pid)),
+            InlineKeyboardButton(text="❌", callback_data=cbd.encode(cbd.CART_DEL, pid))
         ])
     if items:
         kb.append([
-            InlineKeyboardButton(text="🧹 Очистить", callback_data="cart:clear"),
-            InlineKeyboardButton(text="✅ Оформить", callback_data="cart:checkout")
+            InlineKeyboardButton(text="🧹 Очистить", callback_data=cbd.encode(cbd.CART_CLEAR)),
+            InlineKeyboardButton(text="✅ Оформить", callback_data=cbd.encode(cbd.CHECKOUT))
         ])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+async def apply_catalog(new_catalog: Catalog):
+    global catalog, catalog_index
+    index = await asyncio.get_running_loop().run_in_executor(None, prepare_catalog, new_catalog, catalog_index)
+    # Подмена одной ссылкой: новые апдейты сразу видят новый снимок целиком
+    catalog, catalog_index = new_catalog, index
+    logging.info(f"Catalog v{index.version} loaded: {len(index.products)} products")
+
+catalog_watcher = CatalogWatcher(CATALOG_SOURCE, CATALOG_POLL_INTERVAL, apply_catalog) if CATALOG_SOURCE else None
+
 # ==================== Cart ====================
-carts: Dict[int, List[Dict[str, int]]] = {}
-waiting_for_phone: Dict[int, bool] = {}
+storage = create_storage(STORAGE, STORAGE_PATH, STORAGE_FLUSH_INTERVAL, CART_MAX_USERS, CART_TTL)
+
+def digest_text(header: str, lines: List[str]) -> str:
+    text = f"{header}\n\n"
+    shown = 0
+    # Лимит Telegram — 4096 символов на сообщение
+    while shown < len(lines) and len(text) + len(lines[shown]) < 3900:
+        text += lines[shown] + "\n"
+        shown += 1
+    if shown < len(lines):
+        text += f"…и ещё {len(lines) - shown}"
+    return text
+
+async def send_abandoned_digest(batch: List[Dict]):
+    index = current_catalog()
+    lines = [
+        f"{entry['user_id']}: " + ", ".join(
+            f"{index.products[pid]['name']} — {qty} шт." for pid, qty in entry["cart"].items() if pid in index.products
+        )
+        for entry in batch
+    ]
+    # Сводка может подождать: не вытесняет подтверждения заказов из очереди отправки
+    token = send_priority.set(BROWSE)
+    try:
+        await bot.send_message(ADMIN_ID, digest_text(f"🛒 Брошенных корзин: {len(batch)}", lines))
+    finally:
+        send_priority.reset(token)
+
+# Вытеснения копятся и уходят администратору одной сводкой за период очистки, а не сообщением на корзину
+abandoned_digest = (
+    OrderDigest(storage.sweep_interval, send_abandoned_digest) if ABANDONED_CART_NOTIFY_ADMIN and ADMIN_ID else None
+)
+
+def on_cart_abandoned(user_id: int, cart: Dict[str, int]):
+    logging.info(f"Abandoned cart of {user_id} dropped: {len(cart)} items")
+    if abandoned_digest:
+        abandoned_digest.add({"user_id": user_id, "cart": dict(cart)})
+
+storage.on_abandoned = on_cart_abandoned
+
+pricing = Pricing(
+    parse_tiers(WHOLESALE_TIERS) if WHOLESALE_TIERS else DEFAULT_TIERS,
+    load_partner_prices(PARTNER_PRICES_PATH) if PARTNER_PRICES_PATH else None,
+    max_tracked=CART_MAX_USERS or 10000,
+)
+
+def _qty_changed(user_id: int, cart: Dict[str, int], product_id: str, old: int, new: int):
+    index = current_catalog()
+    pricing.changed(user_id, cart, index.prices, index.version, product_id, old, new)
 
 def add_to_cart(user_id: int, product_id: str, qty: int = 1):
     if qty < 1: return
-    carts.setdefault(user_id, [])
-    for it in carts[user_id]:
-        if it["id"] == product_id:
-            it["qty"] += qty
-            return
-    carts[user_id].append({"id": product_id, "qty": qty})
+    cart = storage.get_cart(user_id)
+    old = cart.get(product_id, 0)
+    cart[product_id] = old + qty
+    storage.put_cart(user_id, cart)
+    _qty_changed(user_id, cart, product_id, old, old + qty)
 
 def remove_from_cart(user_id: int, product_id: str):
-    if user_id not in carts: return
-    carts[user_id] = [it for it in carts[user_id] if it["id"] != product_id]
+    cart = storage.get_cart(user_id)
+    old = cart.pop(product_id, None)
+    if old is None: return
+    storage.put_cart(user_id, cart)
+    _qty_changed(user_id, cart, product_id, old, 0)
 
 def set_qty(user_id: int, product_id: str, qty: int):
     if qty < 1:
         remove_from_cart(user_id, product_id)
         return
-    carts.setdefault(user_id, [])
-    for it in carts[user_id]:
-        if it["id"] == product_id:
-            it["qty"] = qty
+    cart = storage.get_cart(user_id)
+    old = cart.get(product_id, 0)
+    cart[product_id] = qty
+    storage.put_cart(user_id, cart)
+    _qty_changed(user_id, cart, product_id, old, qty)
+
+def clear_cart(user_id: int):
+    storage.put_cart(user_id, {})
+    pricing.forget(user_id)
+
+def cart_quote(user_id: int) -> Quote:
+    index = current_catalog()
+    return pricing.quote(pricing.subtotal(user_id, storage.get_cart(user_id), index.prices, index.version))
+
+def format_quote(quote: Quote) -> str:
+    if quote.percent:
+        text = f"Сумма: {quote.subtotal} ₽\nСкидка {quote.percent}%: −{quote.discount} ₽\nИтого: {quote.total} ₽"
+    else:
+        text = f"Итого: {quote.total} ₽"
+    if quote.next_tier:
+        text += f"\nДо скидки {quote.next_tier.percent}% осталось {quote.to_next_tier} ₽"
+    return text
+
+def render_cart(uid: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    lines = cart_lines(uid)
+    if not lines:
+        return "Ваша корзина пуста 🛒", None
+    return f"🛍 Ваша корзина:\n\n{lines}\n\n{format_quote(cart_quote(uid))}", build_cart_keyboard(uid)
+
+class RenderCoalescer:
+    """Сливает повторные перерисовки одного сообщения в одну через delay секунд.
+
+    Состояние читается в момент отправки, поэтому показывается последнее.
+    Если текст и клавиатура не изменились с прошлой отправки, edit не делается;
+    для сравнения хранится только хэш отправленного, а не сам текст с клавиатурой.
+    """
+
+    def __init__(self, delay: float, max_tracked: int = 10000):
+        self.delay = delay
+        self.max_tracked = max_tracked
+        self.pending = set()
+        self.last: "OrderedDict[tuple, int]" = OrderedDict()
+        self.skipped = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def fingerprint(text: str, markup: Optional[InlineKeyboardMarkup]) -> int:
+        return hash((text, markup.model_dump_json() if markup else None))
+
+    def remember(self, key: tuple, text: str, markup: Optional[InlineKeyboardMarkup]):
+        self.last[key] = self.fingerprint(text, markup)
+        self.last.move_to_end(key)
+        if len(self.last) > self.max_tracked:
+            self.last.popitem(last=False)
+
+    async def render(self, key: tuple, build, send):
+        if key in self.pending:
+            self.coalesced += 1
+            return
+        self.pending.add(key)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        finally:
+            self.pending.discard(key)
+        text, markup = build()
+        if self.last.get(key) == self.fingerprint(text, markup):
+            self.skipped += 1
             return
-    carts[user_id].append({"id": product_id, "qty": qty})
+        try:
+            await send(text, markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e): raise
+        self.remember(key, text, markup)
 
-def cart_total(user_id: int) -> Tuple[str, int]:
-    lines, total = [], 0
-    for it in carts.get(user_id, []):
-        p = find_product_by_id(catalog, it["id"])
+cart_renderer = RenderCoalescer(CART_RENDER_DELAY)
+
+async def refresh_cart_message(callback: CallbackQuery):
+    uid, msg = callback.from_user.id, callback.message
+    await cart_renderer.render(
+        (msg.chat.id, msg.message_id),
+        lambda: render_cart(uid),
+        lambda text, markup: msg.edit_text(text, reply_markup=markup),
+    )
+
+# ==================== Orders ====================
+orders = OrderJournal(ORDERS_PATH, ORDERS_FSYNC_INTERVAL)
+# Токен оформления становится номером заказа; повторное «Оформить» в течение окна не шлёт новое приглашение
+checkout_tokens = CheckoutTokens(CART_MAX_USERS or 50000, CART_TTL or 3600)
+CHECKOUT_REPEAT_WINDOW = 10
+
+def build_order(user_id: int, phone: str, order_id: str) -> Dict:
+    index = current_catalog()
+    items = []
+    for pid, qty in storage.get_cart(user_id).items():
+        p = index.products.get(pid)
+        if not p: continue
+        items.append({"id": pid, "name": p["name"], "qty": qty, "price": pricing.unit_price(user_id, pid, index.prices)})
+    quote = cart_quote(user_id)
+    return {
+        "order_id": order_id,
+        "user_id": user_id,
+        "items": items,
+        "subtotal": quote.subtotal,
+        "discount": quote.discount,
+        "total": quote.total,
+        "phone": phone,
+        "ts": int(time.time()),
+    }
+
+sales = SalesAggregator(ORDERS_PATH, REPORT_CHECKPOINT_PATH, REPORT_UTC_OFFSET)
+
+async def send_order_digest(batch: List[Dict]):
+    lines = [f"№{o['order_id']} — {o['total']} ₽, {o['phone']}" for o in batch]
+    header = f"🧾 Новых заказов: {len(batch)} на {sum(o['total'] for o in batch)} ₽"
+    await bot.send_message(ADMIN_ID, digest_text(header, lines))
+
+order_digest = OrderDigest(ORDER_DIGEST_INTERVAL, send_order_digest) if ORDER_DIGEST_INTERVAL and ADMIN_ID else None
+
+def cart_lines(user_id: int) -> str:
+    index = current_catalog()
+    lines = []
+    for pid, qty in storage.get_cart(user_id).items():
+        p = index.products.get(pid)
         if not p: continue
-        price = parse_price_to_int(p["price"])
-        subtotal = price * it["qty"]
-        total += subtotal
-        lines.append(f"{p['name']} — {it['qty']} шт. = {subtotal} ₽")
-    return ("\n".join(lines), total)
+        lines.append(f"{p['name']} — {qty} шт. = {pricing.unit_price(user_id, pid, index.prices) * qty} ₽")
+    return "\n".join(lines)
+
+# ==================== Navigation ====================
+navigator = Navigator()
+CATEGORIES_VIEW: View = ("categories",)
+
+def search_view(query: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    index = current_catalog()
+    found = index.search.search(query, SEARCH_RESULTS_LIMIT)
+    if not found:
+        return "Ничего не нашлось 🔍", None
+    kb = [[InlineKeyboardButton(text=index.products[pid]["name"], callback_data=cbd.encode(cbd.PRODUCT, pid))] for pid in found]
+    return f"Найдено товаров: {len(found)}", InlineKeyboardMarkup(inline_keyboard=kb)
+
+def render_view(view: View) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    if view[0] == "products" and view[1] in current_catalog().catalog:
+        return f"Категория: {view[1]}\nВыберите товар:", build_products_keyboard(view[1])
+    if view[0] == "search":
+        return search_view(view[1])
+    # Категория могла исчезнуть из каталога после перезагрузки
+    return "Выберите категорию:", build_categories_keyboard()
+
+async def show_view(callback: CallbackQuery, view: View, back: bool = False):
+    """Показывает экран view в сообщении с нажатой кнопкой; back — вернуться к предыдущему экрану этого сообщения."""
+    msg = callback.message
+    if NAVIGATION != "edit":
+        text, markup = render_view(view)
+        await msg.answer(text, reply_markup=markup)
+        return
+    chat_id = msg.chat.id
+    if back:
+        view = navigator.back(chat_id, msg.message_id, view)
+    text, markup = render_view(view)
+    try:
+        if msg.text != text:
+            await msg.edit_text(text, reply_markup=markup)
+        elif msg.reply_markup != markup:
+            await msg.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            # Сообщение слишком старое или не текстовое — показываем экран новым сообщением
+            sent = await msg.answer(text, reply_markup=markup)
+            navigator.open(chat_id, sent.message_id, view)
+            return
+    if not back:
+        navigator.push(chat_id, msg.message_id, view)
 
 # ==================== Handlers ====================
+# ==================== Callback dispatch ====================
+CallbackHandler = Callable[[CallbackQuery, CallbackAction], Awaitable]
+callback_handlers: Dict[str, CallbackHandler] = {}
+
+def on_action(code: str):
+    def register(handler: CallbackHandler) -> CallbackHandler:
+        callback_handlers[code] = handler
+        return handler
+    return register
+
+# Кнопки старого формата ("category:<имя>", "cart:inc:<id>", ...) в уже отправленных сообщениях
+LEGACY_PRODUCT_PREFIXES = {
+    "product:": cbd.PRODUCT, "add:": cbd.ADD, "back:products:": cbd.BACK_PRODUCTS,
+    "cart:inc:": cbd.CART_INC, "cart:dec:": cbd.CART_DEC, "cart:del:": cbd.CART_DEL,
+}
+LEGACY_PLAIN = {
+    "back:categories": cbd.BACK_CATEGORIES, "cart:clear": cbd.CART_CLEAR,
+    "cart:checkout": cbd.CHECKOUT, "noop": cbd.NOOP,
+}
+
+def decode_legacy(data: str) -> Optional[CallbackAction]:
+    index = current_catalog()
+    if data in LEGACY_PLAIN:
+        return CallbackAction(LEGACY_PLAIN[data])
+    if data.startswith("category:"):
+        code = index.category_codes.get(data[len("category:"):])
+        return CallbackAction(cbd.CATEGORY, code) if code is not None else None
+    for prefix, code in LEGACY_PRODUCT_PREFIXES.items():
+        if data.startswith(prefix):
+            pid = data[len(prefix):]
+            return CallbackAction(code, pid) if pid in index.products else None
+    return None
+
 @router.message(lambda m: m.text and m.text.lower() in ["/start", "start"])
 async def cmd_start(message: Message):
     await message.answer("Добро пожаловать в BLYUR Cosmetics 💖\nВыберите раздел:", reply_markup=main_kb)
 
+def product_caption(product: Product) -> str:
+    return f"📦 {product['name']}\n💰 {product['price']} ({product['volume']})\n\n{product['desc']}"
+
+@router.message(F.text.startswith("/search"))
+async def cmd_search(message: Message):
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        await message.answer("Напишите, что ищете, например: /search сыворотка")
+        return
+    text, markup = search_view(query)
+    sent = await message.answer(text, reply_markup=markup)
+    if NAVIGATION == "edit" and markup:
+        navigator.open(message.chat.id, sent.message_id, ("search", query))
+
+@router.inline_query()
+async def inline_search(query: InlineQuery):
+    index = current_catalog()
+    text = query.query.strip()
+    found = index.search.search(text, SEARCH_RESULTS_LIMIT) if text else list(index.products)[:SEARCH_RESULTS_LIMIT]
+    results = []
+    for pid in found:
+        product = index.products[pid]
+        kb = build_inline_product_keyboard(pid)
+        file_id = photo_cache.get(pid, product["photo"])
+        if file_id:
+            results.append(InlineQueryResultCachedPhoto(
+                id=pid, photo_file_id=file_id, title=product["name"],
+                caption=product_caption(product), reply_markup=kb,
+            ))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=pid, title=product["name"], description=f"{product['price']} · {product['volume']}",
+                input_message_content=InputTextMessageContent(message_text=product_caption(product)),
+                reply_markup=kb,
+            ))
+    await query.answer(results, cache_time=300)
+
 @router.message(lambda m: m.text and "каталог" in m.text.lower())
 async def show_categories(message: Message):
-    await message.answer("Выберите категорию:", reply_markup=build_categories_keyboard())
+    text, markup = render_view(CATEGORIES_VIEW)
+    sent = await message.answer(text, reply_markup=markup)
+    if NAVIGATION == "edit":
+        navigator.open(message.chat.id, sent.message_id, CATEGORIES_VIEW)
 
-@router.callback_query(lambda c: c.data.startswith("category:"))
-async def cb_show_products(callback: CallbackQuery):
-    cat_name = callback.data.split(":", 1)[1]
-    if cat_name not in catalog:
+@on_action(cbd.CATEGORY)
+async def cb_show_products(callback: CallbackQuery, action: CallbackAction):
+    cat_name = category_of(action.arg)
+    if cat_name is None:
         await callback.answer("Категория не найдена", show_alert=True)
         return
-    await callback.message.answer(f"Категория: {cat_name}\nВыберите товар:", reply_markup=build_products_keyboard(cat_name))
+    await show_view(callback, ("products", cat_name))
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "back:categories")
-async def cb_back_categories(callback: CallbackQuery):
-    await callback.message.answer("Выберите категорию:", reply_markup=build_categories_keyboard())
+@on_action(cbd.BACK_CATEGORIES)
+async def cb_back_categories(callback: CallbackQuery, action: CallbackAction):
+    await show_view(callback, CATEGORIES_VIEW, back=True)
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("back:products:"))
-async def cb_back_products(callback: CallbackQuery):
-    pid = callback.data.split(":", 2)[2]
-    prod = find_product_by_id(catalog, pid)
-    if not prod:
+@on_action(cbd.BACK_PRODUCTS)
+async def cb_back_products(callback: CallbackQuery, action: CallbackAction):
+    msg = callback.message
+    if NAVIGATION == "edit" and navigator.get(msg.chat.id) is not None:
+        # Под фото товара осталась витрина со списком, из которого его открыли
+        try:
+            await msg.delete()
+        except TelegramBadRequest as e:
+            logging.info(f"Cannot delete product message {msg.message_id}: {e}")
+        else:
+            if navigator.photo(msg.chat.id) == msg.message_id:
+                navigator.set_photo(msg.chat.id, None)
+            await callback.answer()
+            return
+    cat_name = current_catalog().categories.get(product_of(action.arg))
+    if not cat_name:
         await callback.answer("Товар не найден", show_alert=True)
         return
-    cat_name = next((name for name, items in catalog.items() if any(i["id"] == pid for i in items)), None)
-    await callback.message.answer(f"Категория: {cat_name}\nВыберите товар:", reply_markup=build_products_keyboard(cat_name))
+    view = ("products", cat_name)
+    text, markup = render_view(view)
+    sent = await msg.answer(text, reply_markup=markup)
+    if NAVIGATION == "edit":
+        navigator.open(msg.chat.id, sent.message_id, view)
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("product:"))
-async def cb_show_product(callback: CallbackQuery):
-    pid = callback.data.split(":", 1)[1]
-    product = find_product_by_id(catalog, pid)
+@on_action(cbd.PRODUCT)
+async def cb_show_product(callback: CallbackQuery, action: CallbackAction):
+    pid = product_of(action.arg)
+    product = current_catalog().products.get(pid)
     if not product:
         await callback.answer("Товар не найден", show_alert=True)
         return
     kb = build_product_keyboard(pid)
-    caption = f"📦 {product['name']}\n💰 {product['price']} ({product['volume']})\n\n{product['desc']}"
-    await bot.send_photo(
-        chat_id=callback.message.chat.id,
-        photo=product['photo'],  # Используем прямую ссылку
-        caption=caption,
-        reply_markup=kb
-    )
+    caption = product_caption(product)
+    msg = callback.message
+    if NAVIGATION == "edit":
+        # Уже открытое фото товара меняем на новое вместо отправки ещё одного
+        photo_id = navigator.photo(msg.chat.id)
+        if photo_id and photo_id != msg.message_id:
+            try:
+                await edit_product_photo(msg.chat.id, photo_id, product, caption, kb)
+                await callback.answer()
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    await callback.answer()
+                    return
+                logging.info(f"Cannot edit product message {photo_id}, sending a new one: {e}")
+    sent = await send_product_photo(msg.chat.id, product, caption=caption, reply_markup=kb)
+    if NAVIGATION == "edit":
+        navigator.set_photo(msg.chat.id, sent.message_id, msg.message_id)
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("add:"))
-async def cb_add_to_cart(callback: CallbackQuery):
-    pid = callback.data.split(":", 1)[1]
+@on_action(cbd.ADD)
+async def cb_add_to_cart(callback: CallbackQuery, action: CallbackAction):
+    pid = product_of(action.arg)
+    if pid is None:
+        await callback.answer("Товар не найден", show_alert=True)
+        return
     add_to_cart(callback.from_user.id, pid)
+    if callback.message is None:
+        # Кнопка из inline-результата в чужом чате — писать туда нельзя
+        await callback.answer("Добавлено в корзину ✅\nОткройте бота, чтобы оформить заказ.", show_alert=True)
+        return
+    if NAVIGATION == "edit":
+        # Вместо отдельного сообщения — количество на кнопке под фото товара
+        await callback.answer("Добавлено в корзину ✅\nОткройте \"🛒 Корзина\" для оформления заказа.")
+        try:
+            await callback.message.edit_reply_markup(
+                reply_markup=product_keyboard_in_cart(pid, storage.get_cart(callback.from_user.id).get(pid, 0)))
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.info(f"Cannot update product keyboard: {e}")
+        return
     await callback.answer("Добавлено в корзину ✅")
     await callback.message.answer("Товар добавлен в корзину ✅\nОткройте \"🛒 Корзина\" для оформления заказа.")
 
 @router.message(lambda m: m.text and "корзина" in m.text.lower())
 async def show_cart(message: Message):
-    uid = message.from_user.id
-    lines, total = cart_total(uid)
-    if not lines:
-        await message.answer("Ваша корзина пуста 🛒")
-        return
-    await message.answer(f"🛍 Ваша корзина:\n\n{lines}\n\nИтого: {total} ₽", reply_markup=build_cart_keyboard(uid))
+    text, markup = render_cart(message.from_user.id)
+    sent = await message.answer(text, reply_markup=markup)
+    cart_renderer.remember((sent.chat.id, sent.message_id), text, markup)
 
 # Cart callbacks
-@router.callback_query(lambda c: c.data.startswith("cart:inc:"))
-async def cb_cart_inc(callback: CallbackQuery):
-    pid = callback.data.split(":", 2)[2]
+@on_action(cbd.CART_INC)
+async def cb_cart_inc(callback: CallbackQuery, action: CallbackAction):
+    pid = product_of(action.arg)
+    if pid is None:
+        await callback.answer("Товар не найден", show_alert=True)
+        return
     add_to_cart(callback.from_user.id, pid)
     await callback.answer("Количество увеличено")
-    lines, total = cart_total(callback.from_user.id)
-    await callback.message.edit_text(f"🛍 Ваша корзина:\n\n{lines}\n\nИтого: {total} ₽", reply_markup=build_cart_keyboard(callback.from_user.id))
+    await refresh_cart_message(callback)
 
-@router.callback_query(lambda c: c.data.startswith("cart:dec:"))
-async def cb_cart_dec(callback: CallbackQuery):
-    pid = callback.data.split(":", 2)[2]
+@on_action(cbd.CART_DEC)
+async def cb_cart_dec(callback: CallbackQuery, action: CallbackAction):
+    pid = product_of(action.arg)
     uid = callback.from_user.id
-    for it in carts.get(uid, []):
-        if it["id"] == pid:
-            set_qty(uid, pid, it["qty"] - 1)
-            break
+    qty = storage.get_cart(uid).get(pid)
+    if qty:
+        set_qty(uid, pid, qty - 1)
     await callback.answer("Количество уменьшено")
-    lines, total = cart_total(callback.from_user.id)
-    await callback.message.edit_text(f"🛍 Ваша корзина:\n\n{lines}\n\nИтого: {total} ₽", reply_markup=build_cart_keyboard(callback.from_user.id))
+    await refresh_cart_message(callback)
 
-@router.callback_query(lambda c: c.data.startswith("cart:del:"))
-async def cb_cart_del(callback: CallbackQuery):
-    pid = callback.data.split(":", 2)[2]
+@on_action(cbd.CART_DEL)
+async def cb_cart_del(callback: CallbackQuery, action: CallbackAction):
+    pid = product_of(action.arg)
     remove_from_cart(callback.from_user.id, pid)
     await callback.answer("Удалено из корзины")
-    lines, total = cart_total(callback.from_user.id)
-    await callback.message.edit_text(f"🛍 Ваша корзина:\n\n{lines}\n\nИтого: {total} ₽", reply_markup=build_cart_keyboard(callback.from_user.id))
+    await refresh_cart_message(callback)
 
-@router.callback_query(lambda c: c.data == "cart:clear")
-async def cb_cart_clear(callback: CallbackQuery):
-    carts[callback.from_user.id] = []
+@on_action(cbd.CART_CLEAR)
+async def cb_cart_clear(callback: CallbackQuery, action: CallbackAction):
+    clear_cart(callback.from_user.id)
     await callback.answer("Корзина очищена")
-    await callback.message.edit_text("Ваша корзина пуста 🛒")
+    await refresh_cart_message(callback)
 
-@router.callback_query(lambda c: c.data == "cart:checkout")
-async def cb_checkout(callback: CallbackQuery):
+@on_action(cbd.CHECKOUT)
+async def cb_checkout(callback: CallbackQuery, action: CallbackAction):
     uid = callback.from_user.id
-    if not carts.get(uid):
+    if not storage.get_cart(uid):
         await callback.answer("Корзина пуста", show_alert=True)
         return
+    _, age = checkout_tokens.issue(uid)
+    if 0 < age < CHECKOUT_REPEAT_WINDOW:
+        # Повторное нажатие «Оформить»: заказ тот же, второе приглашение не нужно
+        await callback.answer("Ждём ваш контакт 👇")
+        return
+    storage.set_waiting_for_phone(uid, True)
     await callback.message.answer("Поделитесь вашим контактом для оформления заказа:", reply_markup=ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="Поделиться контактом", request_contact=True)]
@@ -459,24 +1148,75 @@ async def cb_checkout(callback: CallbackQuery):
 async def receive_contact(message: Message):
     uid = message.from_user.id
     phone = message.contact.phone_number
-    lines, total = cart_total(uid)
-    await message.answer(f"Спасибо! Ваш заказ принят:\n\n{lines}\n\nИтого: {total} ₽\nТелефон: {phone}")
-    carts[uid] = []
+    send_priority.set(ORDER)
+    # Заказ принимается один раз на оформление: повтор контакта не найдёт ни токена, ни флага ожидания
+    order_id = checkout_tokens.consume(uid)
+    if order_id is None:
+        if not storage.is_waiting_for_phone(uid):
+            # Повтор уже принятого заказа приходит при пустой корзине — молча пропускаем
+            if storage.get_cart(uid):
+                await message.answer("Чтобы оформить заказ, нажмите «✅ Оформить» в корзине.")
+            return
+        # Флаг ожидания пережил перезапуск, а токен — нет
+        order_id = uuid.uuid4().hex[:12]
+    if not storage.get_cart(uid):
+        storage.set_waiting_for_phone(uid, False)
+        await message.answer("Корзина пуста 🛒")
+        return
+    lines, totals = cart_lines(uid), format_quote(cart_quote(uid)._replace(next_tier=None))
+    order = build_order(uid, phone, order_id)
+    # Сохранение заказа в журнал (запись на диск — в фоновой задаче)
+    orders.append(order)
+    clear_cart(uid)
+    storage.set_waiting_for_phone(uid, False)
+    await message.answer(f"Спасибо! Ваш заказ №{order['order_id']} принят:\n\n{lines}\n\n{totals}\nТелефон: {phone}")
 
-    # Отправка заказа администратору
-    await bot.send_message(ADMIN_ID, f"Новый заказ:\n\n{lines}\n\nИтого: {total} ₽\nТелефон: {phone}")
+    # Отправка заказа администратору: сразу или в ближайшей сводке
+    if order_digest:
+        order_digest.add(order)
+        return
+    await bot.send_message(ADMIN_ID, f"Новый заказ №{order['order_id']}:\n\n{lines}\n\n{totals}\nТелефон: {phone}")
+
+@router.message(F.text == "/warmup_photos")
+async def cmd_warmup_photos(message: Message):
+    if message.from_user.id != ADMIN_ID: return
+    await message.answer("Загружаю фото каталога…")
+    uploaded = await warmup_photos(PHOTO_WARMUP_CHAT_ID or message.chat.id)
+    await message.answer(f"Готово: загружено {uploaded}, в кэше {len(photo_cache.entries)}.")
 
-    # Сохранение заказа в файл
-    with open("orders.txt", "a", encoding="utf-8") as f:
-        f.write(f"Новый заказ:\n\n{lines}\n\nИтого: {total} ₽\nТелефон: {phone}\n\n")
+REPORT_PERIODS = {"today": "сегодня", "week": "7 дней", "month": "30 дней", "sku": "всё время"}
+
+@router.message(F.text.startswith("/report"))
+async def cmd_report(message: Message):
+    if message.from_user.id != ADMIN_ID: return
+    period = message.text.partition(" ")[2].strip().lower() or "today"
+    if period not in REPORT_PERIODS:
+        await message.answer("Использование: /report today|week|month|sku")
+        return
+    # Заказы, ещё не записанные фоновой задачей, тоже должны попасть в отчёт
+    await orders.flush(fsync=False)
+    await sales.refresh()
+    today = sales.today()
+    first = {"today": today, "week": today - timedelta(days=6), "month": today - timedelta(days=29)}.get(period)
+    summary = sales.summary(first, today if first else None, top=20 if period == "sku" else 5)
+    text = (
+        f"📊 Продажи за {REPORT_PERIODS[period]}\n\n"
+        f"Заказов: {summary.orders}\n"
+        f"Выручка: {summary.revenue} ₽\n"
+        f"Средний чек: {summary.avg_check} ₽ ({summary.avg_items:.1f} шт.)"
+    )
+    if summary.top:
+        text += "\n\nТоп товаров:\n" + "\n".join(
+            f"{n}. {sales.names.get(pid, pid)} — {qty} шт., {rev} ₽" for n, (pid, qty, rev) in enumerate(summary.top, 1)
+        )
+    await message.answer(text)
 
 @router.message(F.text == "💼 Партнёрство")
 async def partnership(message: Message):
+    tiers = "".join(f"🔹 Опт — скидка {t.percent}% (от {t.threshold} ₽).\n" for t in reversed(pricing.tiers))
     text = (
         "🤝 Условия сотрудничества:\n\n"
-        "🔹 Опт — скидка 30% (от 100000 ₽).\n"
-        "🔹 Опт — скидка 20% (от 60000 ₽).\n"
-        "🔹 Опт — скидка 10% (от 30000 ₽).\n"
+        f"{tiers}"
         "🔹 Первые 2 закупки для новых партнёров — по оптовым ценам.\n"
         "🔹 Реализация — срок 2 месяца, вознаграждение 10%-20%.\n\n"
         "Хотите оставить заявку? Напишите ваш телефон."
@@ -488,16 +1228,165 @@ async def about(message: Message):
     await message.answer("🌿 BLYUR Cosmetics — российский бренд профессиональной косметики для мастеров и салонов красоты.\n\n"
         "Мы делаем продукты высокого качества для маникюра, педикюра и косметологии.")
 
-# Debug all callbacks
-@router.callback_query()
-async def debug_callback(callback: CallbackQuery):
-    logging.info(f"Callback received: {callback.data}")
+@on_action(cbd.NOOP)
+async def cb_noop(callback: CallbackQuery, action: CallbackAction):
     await callback.answer()
 
+# Единая точка входа для callback-запросов: разбор данных один раз и поиск обработчика по коду
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery):
+    data = callback.data or ""
+    action = cbd.decode(data) or decode_legacy(data)
+    handler = callback_handlers.get(action.code) if action else None
+    if handler is None:
+        metrics.relabel("unknown_callback")
+        logging.info(f"Callback received: {data}")
+        await callback.answer()
+        return
+    metrics.relabel(handler.__name__)
+    await handler(callback, action)
+
 # ==================== Bootstrap ====================
-async def main():
-    dp.include_router(router)
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+dp.include_router(router)
+for observer in (router.message, router.callback_query, router.inline_query):
+    observer.middleware(metrics.handler_middleware)
+
+metrics.gauge("bot_carts", "Carts held in memory", lambda: len(storage.carts))
+metrics.gauge("bot_storage_evicted", "Users evicted from storage by TTL or size limit", lambda: storage.evicted)
+metrics.gauge("bot_cart_totals_recomputed", "Cart subtotals recomputed from all lines", lambda: pricing.recomputed)
+metrics.gauge("bot_navigation_chats", "Chats with tracked navigation state", lambda: len(navigator.chats))
+metrics.gauge("bot_updates_duplicate", "Redelivered updates skipped", lambda: recent_updates.duplicates)
+metrics.gauge("bot_waiting_for_phone", "Users asked for a contact", lambda: len(storage.waiting_for_phone))
+metrics.gauge("bot_catalog_products", "Products in the current catalog", lambda: len(catalog_index.products))
+metrics.gauge("bot_catalog_version", "Catalog reloads since start", lambda: catalog_index.version)
+metrics.gauge("bot_photo_cache_entries", "Cached photo file_ids", lambda: len(photo_cache.entries))
+metrics.gauge("bot_cart_renders_pending", "Debounced cart edits waiting to be sent", lambda: len(cart_renderer.pending))
+metrics.gauge("bot_cart_renders_coalesced", "Cart edits merged into a later one", lambda: cart_renderer.coalesced)
+metrics.gauge("bot_cart_renders_skipped", "Cart edits skipped as unchanged", lambda: cart_renderer.skipped)
+metrics.gauge("bot_orders_pending", "Orders waiting to be written to the journal", lambda: len(orders.pending))
+for stat in send_scheduler.stats():
+    metrics.gauge(f"bot_send_{stat}", f"Send scheduler {stat.replace('_', ' ')}", lambda stat=stat: send_scheduler.stats()[stat])
+
+async def on_startup():
+    await storage.start()
+    await orders.start()
+    await photo_cache.start()
+    if order_digest:
+        await order_digest.start()
+    if abandoned_digest:
+        await abandoned_digest.start()
+    if catalog_watcher:
+        await catalog_watcher.start()
+    if PHOTO_WARMUP_CHAT_ID:
+        asyncio.create_task(warmup_photos(PHOTO_WARMUP_CHAT_ID))
+    if METRICS_LOG_INTERVAL:
+        asyncio.create_task(metrics.log_periodically(METRICS_LOG_INTERVAL))
+
+async def on_shutdown():
+    if catalog_watcher:
+        await catalog_watcher.close()
+    if order_digest:
+        await order_digest.close()
+    if abandoned_digest:
+        await abandoned_digest.close()
+    await orders.close()
+    await photo_cache.close()
+    await storage.close()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+async def run_polling():
+    if METRICS_PORT:
+        await metrics.serve(WEBAPP_HOST, METRICS_PORT)
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+
+def run_webhook():
+    # aiohttp-сервер нужен только в webhook-режиме
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    async def set_webhook():
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+
+    dp.startup.register(set_webhook)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    metrics.register_route(app)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+def run_cluster():
+    """Вход для Telegram и WORKERS процессов бота (BOT_MODE=worker), апдейты разложены по id пользователя."""
+    import sys
+    from aiohttp import web
+    from cluster import Ingress, Supervisor
+
+    def worker_env(worker):
+        env = {"BOT_MODE": "worker", "WORKER_INDEX": str(worker.index), "WORKER_PORT": str(worker.port)}
+        if worker.index:
+            # Фото прогревает только первый воркер
+            env["PHOTO_WARMUP_CHAT_ID"] = ""
+        return env
+
+    supervisor = Supervisor([sys.executable, os.path.abspath(__file__)], WORKERS, WORKER_BASE_PORT,
+                            env=worker_env, drain_timeout=WORKER_DRAIN_TIMEOUT)
+    ingress = Ingress(supervisor, secret=WEBHOOK_SECRET)
+    # Метрики входа; метрики обработчиков отдаёт каждый воркер на своём порту (/metrics)
+    cluster_metrics = Metrics()
+    cluster_metrics.gauge("bot_cluster_workers_alive", "Running worker processes", lambda: supervisor.alive)
+    cluster_metrics.gauge("bot_cluster_worker_restarts", "Worker restarts after a crash", lambda: supervisor.restarts)
+    cluster_metrics.gauge("bot_cluster_updates_in_flight", "Updates accepted but not yet forwarded", lambda: len(ingress.inflight))
+    cluster_metrics.gauge("bot_cluster_updates_forwarded", "Updates forwarded to workers", lambda: ingress.forwarded)
+    cluster_metrics.gauge("bot_cluster_updates_dropped", "Updates no worker accepted in time", lambda: ingress.dropped)
+
+    async def set_webhook(app):
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+        await bot.session.close()
+
+    app = web.Application()
+    ingress.register(app, WEBHOOK_PATH)
+    cluster_metrics.register_route(app)
+    app.on_startup.append(set_webhook)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=WORKER_DRAIN_TIMEOUT)
+
+def run_worker():
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import setup_application
+    from cluster import worker_app
+
+    async def feed(data: dict):
+        try:
+            await dp.feed_raw_update(bot, data)
+        except Exception:
+            logging.exception(f"Worker {WORKER_INDEX} failed to process update {data.get('update_id')}")
+
+    app = worker_app(feed, WORKER_DRAIN_TIMEOUT)
+    metrics.register_route(app)
+    # Регистрируется после worker_app: хранилище и журнал закрываются, когда начатые апдейты доработали
+    setup_application(app, dp, bot=bot)
+
+    async def close_session(app):
+        # В polling и webhook сессию закрывает aiogram, здесь SimpleRequestHandler нет
+        await bot.session.close()
+
+    app.on_cleanup.append(close_session)
+    web.run_app(app, host="127.0.0.1", port=WORKER_PORT, print=None, access_log=None,
+                shutdown_timeout=WORKER_DRAIN_TIMEOUT)
+
+def main():
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL is required in webhook mode")
+        run_webhook()
+    elif BOT_MODE == "cluster":
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL is required in cluster mode")
+        run_cluster()
+    elif BOT_MODE == "worker":
+        run_worker()
+    else:
+        asyncio.run(run_polling())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -0,0 +1,46 @@
+"""Компактный формат callback_data: <версия><код действия>[<аргумент>].
+
+Например "2pfoam_collagen_mint" — показать товар foam_collagen_mint. Товар
+передаётся своим id, категория — коротким хэшем названия (category_code):
+оба не зависят от порядка в каталоге, поэтому кнопки в старых сообщениях
+ведут туда же после перезагрузки каталога, перезапуска или в другом процессе.
+Версия 1 передавала порядковые номера, которые этим свойством не обладали,
+такие кнопки больше не разбираются.
+"""
+import hashlib
+from typing import NamedTuple, Optional
+
+VERSION = "2"
+# Лимит Telegram — 64 байта на callback_data, два из них занимают версия и код
+MAX_ARG_BYTES = 64 - 2
+
+# Коды действий
+CATEGORY = "c"        # arg: код категории
+PRODUCT = "p"         # arg: id товара
+ADD = "a"             # arg: id товара
+BACK_CATEGORIES = "k"
+BACK_PRODUCTS = "b"   # arg: id товара
+CART_INC = "i"        # arg: id товара
+CART_DEC = "d"        # arg: id товара
+CART_DEL = "x"        # arg: id товара
+CART_CLEAR = "z"
+CHECKOUT = "o"
+NOOP = "n"
+
+
+class CallbackAction(NamedTuple):
+    code: str
+    arg: Optional[str] = None
+
+
+def category_code(name: str) -> str:
+    return hashlib.blake2b(name.encode("utf-8"), digest_size=5).hexdigest()
+
+
+def encode(code: str, arg: Optional[str] = None) -> str:
+    return f"{VERSION}{code}" if arg is None else f"{VERSION}{code}{arg}"
+
+
+def decode(data: str) -> Optional[CallbackAction]:
+    if len(data) < 2 or data[0] != VERSION: return None
+    return CallbackAction(data[1], data[2:] or None)
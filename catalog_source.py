@@ -0,0 +1,147 @@
+"""Загрузка каталога из внешнего источника и отслеживание его изменений.
+
+Поддерживаемые источники (CATALOG_SOURCE):
+  catalog.json          — {"Категория": [{товар}, ...]} или список товаров с полем "category"
+  catalog.csv           — колонки category,id,name,price,desc,volume,photo
+  sqlite:catalog.db     — таблица products с теми же колонками (порядок — по rowid)
+
+Изменения определяются опросом mtime файла раз в interval секунд.
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import sqlite3
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from callbacks import MAX_ARG_BYTES, category_code
+
+Catalog = Dict[str, List[Dict[str, str]]]
+
+PRODUCT_FIELDS = ("id", "name", "price", "desc", "volume", "photo")
+
+
+class CatalogError(Exception):
+    pass
+
+
+def parse_price_to_int(price: str) -> int:
+    s = price.replace("₽", "").replace("р.", "").replace("руб.", "").replace(" ", "").replace("\u00A0", "").strip()
+    return int(s) if s else 0
+
+
+def _group(rows) -> Catalog:
+    cat: Catalog = {}
+    for row in rows:
+        row = dict(row)
+        cat_name = row.pop("category", None)
+        if not cat_name:
+            raise CatalogError(f"Product {row.get('id')!r} has no category")
+        cat.setdefault(cat_name, []).append(row)
+    return cat
+
+
+def _sqlite_path(source: str) -> str:
+    return source[len("sqlite:"):]
+
+
+def load_catalog(source: str) -> Catalog:
+    if source.startswith("sqlite:"):
+        db = sqlite3.connect(f"file:{_sqlite_path(source)}?mode=ro", uri=True)
+        try:
+            db.row_factory = sqlite3.Row
+            cat = _group(db.execute(f"SELECT category, {', '.join(PRODUCT_FIELDS)} FROM products ORDER BY rowid"))
+        finally:
+            db.close()
+    elif source.endswith(".csv"):
+        with open(source, encoding="utf-8", newline="") as f:
+            cat = _group(csv.DictReader(f))
+    else:
+        with open(source, encoding="utf-8") as f:
+            data = json.load(f)
+        cat = _group(data) if isinstance(data, list) else data
+    validate_catalog(cat)
+    return cat
+
+
+def validate_catalog(cat: Catalog):
+    seen = set()
+    codes = {}
+    for cat_name, items in cat.items():
+        code = category_code(cat_name)
+        if code in codes:
+            raise CatalogError(f"Categories {codes[code]!r} and {cat_name!r} share callback code {code}")
+        codes[code] = cat_name
+        for it in items:
+            missing = [field for field in PRODUCT_FIELDS if not isinstance(it.get(field), str)]
+            if missing:
+                raise CatalogError(f"Product {it.get('id')!r} in {cat_name!r} lacks {', '.join(missing)}")
+            try:
+                parse_price_to_int(it["price"])
+            except ValueError:
+                raise CatalogError(f"Product {it['id']!r} has unparsable price {it['price']!r}")
+            # id товара передаётся в callback_data как есть
+            if len(it["id"].encode("utf-8")) > MAX_ARG_BYTES:
+                raise CatalogError(f"Product id {it['id']!r} is longer than {MAX_ARG_BYTES} bytes")
+            if it["id"] in seen:
+                raise CatalogError(f"Duplicate product id {it['id']!r}")
+            seen.add(it["id"])
+
+
+def source_mtime(source: str) -> Optional[float]:
+    paths = [_sqlite_path(source), _sqlite_path(source) + "-wal"] if source.startswith("sqlite:") else [source]
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+class CatalogWatcher:
+    """Опрашивает mtime источника и при изменении передаёт новый каталог в on_change.
+
+    Чтение и разбор файла выполняются в пуле потоков, чтобы не задерживать event loop.
+    """
+
+    def __init__(self, source: str, interval: float, on_change: Callable[[Catalog], Awaitable]):
+        self.source = source
+        self.interval = interval
+        self.on_change = on_change
+        self.mtime = source_mtime(source)
+        self.task: Optional[asyncio.Task] = None
+
+    async def check(self) -> bool:
+        loop = asyncio.get_running_loop()
+        mtime = await loop.run_in_executor(None, source_mtime, self.source)
+        if mtime is None or mtime == self.mtime:
+            return False
+        try:
+            cat = await loop.run_in_executor(None, load_catalog, self.source)
+        except (OSError, ValueError, sqlite3.Error, CatalogError) as e:
+            # Файл мог быть прочитан посреди записи — попробуем на следующем опросе
+            logging.warning(f"Catalog reload from {self.source} failed, keeping current catalog: {e}")
+            return False
+        await self.on_change(cat)
+        # Запоминаем только применённый каталог, иначе неудачный файл больше не перечитается
+        self.mtime = mtime
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logging.exception("Catalog watcher failed")
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
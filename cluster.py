@@ -0,0 +1,216 @@
+"""Несколько процессов-воркеров бота за одним webhook-входом.
+
+Supervisor запускает воркеры отдельными процессами и перезапускает упавшие.
+Ingress принимает апдейты от Telegram, сразу отвечает 200 и пересылает апдейт
+воркеру с номером user_id % workers. Поэтому состояние пользователя живёт
+ровно в одном процессе и межпроцессные блокировки не нужны. Апдейты одного
+пользователя пересылаются строго по очереди, в порядке поступления.
+
+Остановка: Ingress перестаёт принимать апдейты (Telegram повторит их позже)
+и дожидается пересылки принятых, затем воркеры получают SIGTERM и дорабатывают
+начатые апдейты.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+
+def update_user_id(update: dict) -> int:
+    """id автора апдейта; для апдейтов без пользователя — id чата, иначе 0."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict): continue
+        user = value.get("from") or value.get("user")
+        if user: return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat: return chat["id"]
+    return 0
+
+
+def shard_of(user_id: int, workers: int) -> int:
+    # Остаток от id стабилен между процессами и перезапусками, в отличие от hash() строк
+    return user_id % workers
+
+
+class Worker:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}/update"
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.restarts = 0
+
+
+class Supervisor:
+    """Держит запущенными workers процессов command и перезапускает упавшие с нарастающей паузой."""
+
+    def __init__(self, command: List[str], workers: int, base_port: int,
+                 env: Optional[Callable[[Worker], Dict[str, str]]] = None, drain_timeout: float = 30):
+        self.command = command
+        self.workers = [Worker(i, base_port + i) for i in range(workers)]
+        self.env = env
+        self.drain_timeout = drain_timeout
+        self.stopping = False
+        self.tasks: List[asyncio.Task] = []
+
+    @property
+    def alive(self) -> int:
+        return sum(1 for w in self.workers if w.process and w.process.returncode is None)
+
+    @property
+    def restarts(self) -> int:
+        return sum(w.restarts for w in self.workers)
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self._keep_running(w)) for w in self.workers]
+
+    async def _keep_running(self, worker: Worker):
+        backoff = 1.0
+        while not self.stopping:
+            env = dict(os.environ, **(self.env(worker) if self.env else {}))
+            started = time.monotonic()
+            # Своя группа процессов: Ctrl+C в терминале не должен остановить воркеры раньше входа
+            worker.process = await asyncio.create_subprocess_exec(*self.command, env=env, start_new_session=True)
+            logging.info(f"Worker {worker.index} started (pid {worker.process.pid}, port {worker.port})")
+            code = await worker.process.wait()
+            if self.stopping: return
+            worker.restarts += 1
+            backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, 30.0)
+            logging.error(f"Worker {worker.index} exited with code {code}, restarting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+
+    async def stop(self):
+        self.stopping = True
+        running = [w.process for w in self.workers if w.process and w.process.returncode is None]
+        for proc in running:
+            proc.send_signal(signal.SIGTERM)
+        for proc in running:
+            try:
+                await asyncio.wait_for(proc.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Worker pid {proc.pid} did not stop in {self.drain_timeout}s, killing")
+                proc.kill()
+                await proc.wait()
+        for task in self.tasks:
+            task.cancel()
+
+
+class Ingress:
+    """Принимает webhook-апдейты и раскладывает их по воркерам Supervisor'а."""
+
+    def __init__(self, supervisor: Supervisor, secret: Optional[str] = None, retry_timeout: float = 30):
+        self.supervisor = supervisor
+        self.secret = secret
+        self.retry_timeout = retry_timeout
+        self.session: Optional[ClientSession] = None
+        # Последняя пересылка каждого пользователя: следующая ждёт её завершения
+        self.chains: Dict[int, asyncio.Task] = {}
+        self.inflight: Set[asyncio.Task] = set()
+        self.accepting = True
+        self.forwarded = 0
+        self.dropped = 0
+
+    def register(self, app: web.Application, path: str):
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+
+    async def _on_startup(self, app):
+        self.session = ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=10))
+        await self.supervisor.start()
+
+    async def _on_shutdown(self, app):
+        await self.drain()
+        await self.supervisor.stop()
+        await self.session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+        if not self.accepting:
+            # Не 200 — Telegram доставит апдейт повторно после перезапуска
+            return web.Response(status=503)
+        body = await request.read()
+        try:
+            user_id = update_user_id(json.loads(body))
+        except (ValueError, AttributeError, TypeError, KeyError):
+            return web.Response(status=400)
+        worker = self.supervisor.workers[shard_of(user_id, len(self.supervisor.workers))]
+        task = asyncio.create_task(self._forward(worker, body, self.chains.get(user_id)))
+        self.chains[user_id] = task
+        self.inflight.add(task)
+        task.add_done_callback(lambda t: self._done(user_id, t))
+        return web.json_response({})
+
+    def _done(self, user_id: int, task: asyncio.Task):
+        self.inflight.discard(task)
+        if self.chains.get(user_id) is task:
+            del self.chains[user_id]
+
+    async def _forward(self, worker: Worker, body: bytes, previous: Optional[asyncio.Task]):
+        if previous:
+            await asyncio.wait([previous])
+        deadline = time.monotonic() + self.retry_timeout
+        while True:
+            try:
+                async with self.session.post(worker.url, data=body, headers={"Content-Type": "application/json"}) as resp:
+                    if resp.status == 200:
+                        self.forwarded += 1
+                        return
+                    error = f"HTTP {resp.status}"
+            except (ClientError, asyncio.TimeoutError) as e:
+                # Воркер перезапускается или ещё не поднялся
+                error = repr(e)
+            if time.monotonic() > deadline:
+                self.dropped += 1
+                logging.error(f"Dropping update for worker {worker.index}: {error}")
+                return
+            await asyncio.sleep(0.2)
+
+    async def drain(self, timeout: Optional[float] = None):
+        self.accepting = False
+        if self.inflight:
+            logging.info(f"Draining {len(self.inflight)} updates in flight")
+            await asyncio.wait(list(self.inflight), timeout=timeout or self.retry_timeout)
+
+
+def worker_app(feed: Callable[[dict], Awaitable], drain_timeout: float = 30) -> web.Application:
+    """Приложение воркера: принимает апдейты от Ingress и обрабатывает их в фоне.
+
+    При остановке дожидается начатых обработок (не дольше drain_timeout).
+    Если Supervisor пропал, воркер останавливается сам.
+    """
+    tasks: Set[asyncio.Task] = set()
+
+    async def handle(request: web.Request) -> web.Response:
+        task = asyncio.create_task(feed(await request.json()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.json_response({})
+
+    async def watch_parent():
+        parent = os.getppid()
+        while os.getppid() == parent:
+            await asyncio.sleep(1)
+        logging.warning("Supervisor is gone, shutting down")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def on_startup(app):
+        app["watch_parent"] = asyncio.create_task(watch_parent())
+
+    async def on_shutdown(app):
+        app["watch_parent"].cancel()
+        if tasks:
+            logging.info(f"Draining {len(tasks)} updates")
+            await asyncio.wait(list(tasks), timeout=drain_timeout)
+
+    app = web.Application()
+    app.router.add_post("/update", handle)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
@@ -0,0 +1,71 @@
+"""Защита от повторной обработки: недавние update_id и токены оформления заказа.
+
+Telegram повторяет доставку webhook'а, если не дождался ответа, а polling после
+перезапуска заново получает неподтверждённые апдейты. RecentIds помнит id,
+увиденные за последние ttl секунд (не больше max_size штук), CheckoutTokens
+выдаёт на каждое оформление заказа один токен, который можно погасить только
+один раз. Обе структуры — OrderedDict в порядке добавления: проверка O(1),
+устаревшие записи снимаются с головы.
+"""
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class RecentIds:
+    def __init__(self, max_size: int = 50000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.ids: "OrderedDict[int, float]" = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, key: int) -> bool:
+        """True, если key уже встречался в окне; иначе запоминает его."""
+        now = time.monotonic()
+        ids = self.ids
+        while ids:
+            oldest, ts = next(iter(ids.items()))
+            if now - ts < self.ttl: break
+            del ids[oldest]
+        if key in ids:
+            self.duplicates += 1
+            return True
+        ids[key] = now
+        if len(ids) > self.max_size:
+            ids.popitem(last=False)
+        return False
+
+
+class CheckoutTokens:
+    """Токен оформления на пользователя: выдаётся при «Оформить», гасится принятием заказа."""
+
+    def __init__(self, max_size: int = 50000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tokens: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+    def _expire(self, now: float):
+        while self.tokens:
+            uid, (_, issued) = next(iter(self.tokens.items()))
+            if now - issued < self.ttl: break
+            del self.tokens[uid]
+
+    def issue(self, uid: int) -> Tuple[str, float]:
+        """Токен пользователя и сколько секунд назад он выдан (0 — только что создан)."""
+        now = time.monotonic()
+        self._expire(now)
+        current = self.tokens.get(uid)
+        if current is not None:
+            return current[0], now - current[1]
+        token = uuid.uuid4().hex[:12]
+        self.tokens[uid] = (token, now)
+        if len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+        return token, 0.0
+
+    def consume(self, uid: int) -> Optional[str]:
+        """Забирает токен; повторный вызов вернёт None."""
+        self._expire(time.monotonic())
+        entry = self.tokens.pop(uid, None)
+        return entry[0] if entry else None
@@ -0,0 +1,65 @@
+"""HTTP-сессия Bot API с настраиваемым пулом соединений и таймаутами по методам.
+
+Поверх AiohttpSession из aiogram:
+- размер пула и keep-alive: соединения к Bot API переиспользуются, в том числе
+  между вызовами тёплой облачной функции;
+- кэш DNS на dns_ttl секунд;
+- таймаут на каждый метод (method_timeouts), остальным — общий timeout;
+- тяжёлые методы (загрузка фото) занимают не больше media_concurrency
+  соединений, поэтому медленная отправка фото не задерживает правки корзины
+  и ответы на нажатия.
+"""
+import asyncio
+from typing import Dict, Iterable, Optional, Tuple
+
+from aiohttp import ClientTimeout
+from aiogram.client.session.aiohttp import AiohttpSession
+
+MEDIA_METHODS = frozenset({
+    "sendPhoto", "sendDocument", "sendVideo", "sendAnimation", "sendMediaGroup", "editMessageMedia",
+})
+
+
+def parse_method_timeouts(spec: str) -> Dict[str, float]:
+    """"sendPhoto:30,answerCallbackQuery:5" -> {"sendPhoto": 30.0, ...}."""
+    result = {}
+    for part in spec.split(","):
+        if not part.strip(): continue
+        method, timeout = part.split(":")
+        result[method.strip()] = float(timeout)
+    return result
+
+
+class TunedSession(AiohttpSession):
+    def __init__(self, pool_size: int = 100, keepalive: float = 30, dns_ttl: int = 300, connect_timeout: float = 5,
+                 method_timeouts: Optional[Dict[str, float]] = None, media_concurrency: int = 0,
+                 media_methods: Iterable[str] = MEDIA_METHODS, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(
+            limit=pool_size,
+            keepalive_timeout=keepalive,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_ttl,
+        )
+        self.connect_timeout = connect_timeout
+        self.method_timeouts = method_timeouts or {}
+        self.media_concurrency = media_concurrency
+        self.media_methods = frozenset(media_methods)
+        # Семафор создаётся внутри работающего loop: в Python 3.8 он привязывается к loop при создании
+        self._media_slots: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+    def _media_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._media_slots is None or self._media_slots[0] is not loop:
+            self._media_slots = (loop, asyncio.Semaphore(self.media_concurrency))
+        return self._media_slots[1]
+
+    async def make_request(self, bot, method, timeout: Optional[float] = None):
+        name = method.__api_method__
+        if timeout is None:
+            timeout = self.method_timeouts.get(name, self.timeout)
+        client_timeout = ClientTimeout(total=timeout, connect=min(self.connect_timeout, timeout))
+        if self.media_concurrency and name in self.media_methods:
+            async with self._media_semaphore():
+                return await super().make_request(bot, method, timeout=client_timeout)
+        return await super().make_request(bot, method, timeout=client_timeout)
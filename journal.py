@@ -0,0 +1,112 @@
+"""Журнал заказов: одна JSON-запись на строку.
+
+Обработчики только ставят запись в очередь (append), запись на диск делает фоновая
+задача: накопленные записи пишутся одним вызовом write() в файл, открытый на
+дозапись, поэтому в один журнал могут писать несколько процессов. fsync — не
+чаще раза в fsync_interval секунд и обязательно при закрытии.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+
+Order = Dict[str, Any]
+
+
+class OrderJournal:
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.pending: List[str] = []
+        self.file = None
+        self.last_fsync = 0.0
+        self.unsynced = False
+        # Event и Lock создаются внутри работающего loop: в Python 3.8 они привязываются к loop при создании
+        self.wakeup: Optional[asyncio.Event] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def append(self, order: Order):
+        self.pending.append(json.dumps(order, ensure_ascii=False) + "\n")
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._writer())
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush(fsync=time.monotonic() - self.last_fsync >= self.fsync_interval)
+            except Exception:
+                logging.exception(f"Order journal {self.path} write failed")
+
+    async def flush(self, fsync: bool = True):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.pending:
+                batch, self.pending = self.pending, []
+                if self.file is None:
+                    # Без буфера: строки других процессов не окажутся посреди нашей пачки
+                    self.file = await aiofiles.open(self.path, "ab", buffering=0)
+                try:
+                    data = "".join(batch).encode("utf-8")
+                    while data:
+                        data = data[await self.file.write(data):]
+                except Exception:
+                    self.pending[:0] = batch
+                    raise
+                self.unsynced = True
+            if fsync and self.unsynced:
+                await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.file.fileno())
+                self.unsynced = False
+                self.last_fsync = time.monotonic()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush(fsync=True)
+        if self.file is not None:
+            await self.file.close()
+            self.file = None
+
+
+async def read_orders_since(path: str, offset: int = 0) -> AsyncIterator[Tuple[int, Order]]:
+    """Читает записи начиная с байтового смещения offset, отдаёт (смещение после записи, запись).
+
+    Недописанная последняя строка пропускается — её прочитает следующий вызов.
+    """
+    try:
+        f = await aiofiles.open(path, "rb")
+    except FileNotFoundError:
+        return
+    try:
+        await f.seek(offset)
+        async for line in f:
+            if not line.endswith(b"\n"): break
+            offset += len(line)
+            if not line.strip(): continue
+            try:
+                yield offset, json.loads(line)
+            except ValueError:
+                logging.warning(f"Skipping malformed order record in {path} before offset {offset}")
+    finally:
+        await f.close()
+
+
+async def read_orders(path: str) -> AsyncIterator[Order]:
+    async for _, order in read_orders_since(path):
+        yield order
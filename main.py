@@ -0,0 +1,92 @@
+"""Точка входа Yandex Cloud Function (function_entrypoint: main.handler).
+
+Каждый вызов получает один webhook-апдейт от Telegram и передаёт его в dp.feed_update.
+Модуль bot (и вместе с ним aiogram) импортируется при первом вызове, в тёплом
+контейнере переиспользуются тот же event loop и та же HTTP-сессия Bot с её
+пулом открытых соединений к Bot API. При остановке контейнера сессия закрывается.
+"""
+import asyncio
+import atexit
+import base64
+import json
+import logging
+import os
+
+_loop = None
+_bot = None
+
+
+def _runtime():
+    global _loop, _bot
+    if _bot is None:
+        # Каждый вызов обрабатывает один апдейт: сливать перерисовки не с чем, задержка была бы чистой потерей
+        os.environ.setdefault("CART_RENDER_DELAY", "0")
+        import bot as bot_module
+        _bot = bot_module
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+        atexit.register(_close)
+    return _loop, _bot
+
+
+async def _shutdown(rt):
+    for digest in (rt.order_digest, rt.abandoned_digest):
+        if digest:
+            await digest.flush()
+    await rt.bot.session.close()
+
+
+def _close():
+    if _loop.is_closed(): return
+    try:
+        _loop.run_until_complete(_shutdown(_bot))
+    except Exception:
+        logging.exception("Failed to shut down bot runtime")
+    _loop.close()
+
+
+def _response(status: int, body: str = "") -> dict:
+    return {"statusCode": status, "body": body}
+
+
+async def _process(rt, data: dict):
+    from aiogram.types import Update
+    if rt.catalog_watcher:
+        await rt.catalog_watcher.check()
+    update = Update.model_validate(data, context={"bot": rt.bot})
+    await rt.dp.feed_update(rt.bot, update)
+    # Фоновой очистки между вызовами нет: неактивные корзины снимаются здесь, до записи хранилища
+    rt.storage.sweep_if_due()
+    # Контейнер может быть заморожен сразу после ответа — отложенную запись не откладываем
+    await rt.storage.flush()
+    await rt.orders.flush()
+    await rt.photo_cache.flush()
+    # Сводки заказов и брошенных корзин — тоже здесь, когда подошёл их срок
+    if rt.order_digest:
+        await rt.order_digest.flush_if_due()
+    if rt.abandoned_digest:
+        await rt.abandoned_digest.flush_if_due()
+
+
+def handler(event, context):
+    secret = os.getenv("WEBHOOK_SECRET")
+    if secret:
+        headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+        if headers.get("x-telegram-bot-api-secret-token") != secret:
+            return _response(401)
+
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode("utf-8")
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return _response(400)
+
+    loop, rt = _runtime()
+    try:
+        loop.run_until_complete(_process(rt, data))
+    except Exception:
+        # Telegram повторит доставку при не-200 ответе, а повтор упавшего апдейта обычно снова упадёт
+        logging.exception(f"Failed to process update {data.get('update_id')}")
+    return _response(200)
@@ -0,0 +1,175 @@
+"""Метрики обработчиков и вызовов Bot API в формате Prometheus.
+
+Metrics.handler_middleware подключается как inner middleware к событиям роутера
+и считает вызовы, ошибки и время работы каждого обработчика. ApiMetricsMiddleware
+подключается к сессии бота и отдельно измеряет время внутри запросов к Bot API.
+Размеры состояния процесса регистрируются через gauge() и читаются в момент выгрузки.
+"""
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "errors", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float, error: bool = False):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе бакета."""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self):
+        self.handlers: Dict[str, Histogram] = {}
+        self.api: Dict[str, Histogram] = {}
+        self.gauges: List[Tuple[str, str, Callable[[], float]]] = []
+        # Изменяемое имя текущего обработчика: диспетчер callback'ов уточняет его через relabel()
+        self.label: ContextVar[Optional[List[str]]] = ContextVar("metrics_handler_label", default=None)
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], float]):
+        self.gauges.append((name, help_text, fn))
+
+    def relabel(self, name: str):
+        label = self.label.get()
+        if label is not None:
+            label[0] = name
+
+    async def handler_middleware(self, handler, event, data):
+        label = [data["handler"].callback.__name__]
+        token = self.label.set(label)
+        start = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.label.reset(token)
+            self.observe(self.handlers, label[0], time.perf_counter() - start, error)
+
+    @staticmethod
+    def observe(table: Dict[str, Histogram], name: str, seconds: float, error: bool = False):
+        hist = table.get(name)
+        if hist is None:
+            hist = table[name] = Histogram()
+        hist.observe(seconds, error)
+
+    def render(self) -> str:
+        out = []
+        for metric, label, table, help_text in (
+            ("bot_handler", "handler", self.handlers, "Update handler"),
+            ("bot_api_request", "method", self.api, "Bot API request"),
+        ):
+            out.append(f"# HELP {metric}_seconds {help_text} latency")
+            out.append(f"# TYPE {metric}_seconds histogram")
+            for name, hist in sorted(table.items()):
+                lbl = f'{label}="{_escape(name)}"'
+                cumulative = 0
+                for bound, n in zip(BUCKETS + (float("inf"),), hist.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append(f'{metric}_seconds_bucket{{{lbl},le="{le}"}} {cumulative}')
+                out.append(f"{metric}_seconds_sum{{{lbl}}} {hist.sum}")
+                out.append(f"{metric}_seconds_count{{{lbl}}} {hist.count}")
+            out.append(f"# HELP {metric}_errors_total {help_text} errors")
+            out.append(f"# TYPE {metric}_errors_total counter")
+            for name, hist in sorted(table.items()):
+                out.append(f'{metric}_errors_total{{{label}="{_escape(name)}"}} {hist.errors}')
+        for name, help_text, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                logging.exception(f"Metric {name} failed")
+                continue
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> str:
+        parts = []
+        for title, table in (("handlers", self.handlers), ("api", self.api)):
+            rows = sorted(table.items(), key=lambda kv: -kv[1].count)
+            parts.append(f"{title}: " + ", ".join(
+                f"{name} n={h.count} err={h.errors} p50<={h.quantile(0.5)}s p99<={h.quantile(0.99)}s"
+                for name, h in rows
+            ))
+        gauges = []
+        for name, _, fn in self.gauges:
+            try:
+                gauges.append(f"{name}={fn()}")
+            except Exception:
+                pass
+        parts.append("state: " + ", ".join(gauges))
+        return "; ".join(parts)
+
+    async def handle_http(self, request):
+        from aiohttp import web
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    def register_route(self, app, path: str = "/metrics"):
+        app.router.add_get(path, self.handle_http)
+
+    async def serve(self, host: str, port: int):
+        from aiohttp import web
+        app = web.Application()
+        self.register_route(app)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+        return runner
+
+    async def log_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            logging.info(f"Metrics: {self.summary()}")
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        error = False
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.observe(self.metrics.api, method.__api_method__, time.perf_counter() - start, error)
@@ -0,0 +1,78 @@
+"""Состояние навигации по каталогу в режиме правки сообщений на месте.
+
+Для каждого чата помнится сообщение-витрина со стеком показанных в нём экранов:
+переход к новому экрану правит витрину и кладёт экран в стек, «назад» снимает
+его и возвращает предыдущий. Текстовое сообщение нельзя превратить в фото,
+поэтому товар показывается отдельным сообщением поверх витрины: следующий товар
+заменяет в нём фото, а «назад» удаляет его и открывает витрину под ним.
+"""
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# ("categories",), ("products", <категория>), ("search", <запрос>)
+View = Tuple
+
+
+class ChatView:
+    __slots__ = ("message_id", "stack", "photo_id")
+
+    def __init__(self, message_id: int, view: Optional[View] = None):
+        self.message_id = message_id
+        self.stack: List[View] = [view] if view else []
+        self.photo_id: Optional[int] = None
+
+
+class Navigator:
+    def __init__(self, max_chats: int = 10000, max_depth: int = 10):
+        self.max_chats = max_chats
+        self.max_depth = max_depth
+        self.chats: "OrderedDict[int, ChatView]" = OrderedDict()
+
+    def get(self, chat_id: int, message_id: Optional[int] = None) -> Optional[ChatView]:
+        """Состояние чата; если задан message_id — только когда витрина именно это сообщение."""
+        state = self.chats.get(chat_id)
+        if state is None or message_id is not None and state.message_id != message_id: return None
+        self.chats.move_to_end(chat_id)
+        return state
+
+    def open(self, chat_id: int, message_id: int, view: Optional[View] = None) -> ChatView:
+        """Новая витрина: прежняя и открытое над ней фото больше не правятся."""
+        state = self.chats[chat_id] = ChatView(message_id, view)
+        self.chats.move_to_end(chat_id)
+        if len(self.chats) > self.max_chats:
+            self.chats.popitem(last=False)
+        return state
+
+    def push(self, chat_id: int, message_id: int, view: View):
+        state = self.get(chat_id, message_id)
+        if state is None:
+            # Витрина из старого сообщения или после перезапуска — история начинается заново
+            photo_id = self.chats[chat_id].photo_id if chat_id in self.chats else None
+            self.open(chat_id, message_id, view).photo_id = photo_id
+            return
+        state.stack.append(view)
+        if len(state.stack) > self.max_depth:
+            del state.stack[0]
+
+    def back(self, chat_id: int, message_id: int, default: View) -> View:
+        """Снимает текущий экран витрины и возвращает тот, что был до него (или default)."""
+        state = self.get(chat_id, message_id)
+        if state is None or len(state.stack) < 2:
+            self.push(chat_id, message_id, default)
+            state = self.chats[chat_id]
+            state.stack[:] = [default]
+            return default
+        state.stack.pop()
+        return state.stack[-1]
+
+    def photo(self, chat_id: int) -> Optional[int]:
+        state = self.chats.get(chat_id)
+        return state.photo_id if state else None
+
+    def set_photo(self, chat_id: int, message_id: Optional[int], list_message_id: Optional[int] = None):
+        """Запоминает фото товара, открытое из списка list_message_id."""
+        state = self.chats.get(chat_id)
+        if state is None:
+            if message_id is None or list_message_id is None: return
+            state = self.open(chat_id, list_message_id)
+        state.photo_id = message_id
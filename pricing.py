@@ -0,0 +1,107 @@
+"""Оптовые цены: скидка по сумме корзины и персональные прайс-листы партнёров.
+
+Цена строки — цена из прайс-листа партнёра, если товар в нём есть, иначе цена
+каталога. Скидка ступени считается от суммы корзины по этим ценам.
+
+Сумма корзины ведётся нарастающим итогом: при каждом изменении количества она
+поправляется на разницу (changed), поэтому перерисовка корзины не пересчитывает
+все строки. Итог пересчитывается целиком, только если сменился каталог или
+корзина была заново загружена из хранилища.
+"""
+import json
+import logging
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterable, Mapping, NamedTuple, Optional
+
+PriceList = Dict[str, int]
+
+
+class Tier(NamedTuple):
+    threshold: int
+    percent: int
+
+
+DEFAULT_TIERS = (Tier(30000, 10), Tier(60000, 20), Tier(100000, 30))
+
+
+class Quote(NamedTuple):
+    subtotal: int
+    percent: int
+    discount: int
+    total: int
+    # Следующая ступень и сколько до неё не хватает
+    next_tier: Optional[Tier]
+    to_next_tier: int
+
+
+def parse_tiers(spec: str) -> Iterable[Tier]:
+    """"30000:10,60000:20" -> ступени скидки."""
+    for part in spec.split(","):
+        if not part.strip(): continue
+        threshold, percent = part.split(":")
+        yield Tier(int(threshold), int(percent))
+
+
+def load_partner_prices(path: str) -> Dict[int, PriceList]:
+    """JSON вида {"<user_id>": {"<product_id>": цена, ...}, ...}."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        logging.warning(f"Partner price lists {path} not found")
+        return {}
+    return {int(uid): {pid: int(price) for pid, price in prices.items()} for uid, prices in raw.items()}
+
+
+class Pricing:
+    def __init__(self, tiers: Iterable[Tier] = DEFAULT_TIERS, partner_prices: Optional[Dict[int, PriceList]] = None,
+                 max_tracked: int = 10000):
+        self.tiers = sorted(tiers)
+        self.thresholds = [t.threshold for t in self.tiers]
+        self.partner_prices = partner_prices or {}
+        self.max_tracked = max_tracked
+        # user_id -> [корзина, версия каталога, сумма]; запись верна, пока это тот же объект корзины
+        self.subtotals: "OrderedDict[int, list]" = OrderedDict()
+        self.recomputed = 0
+
+    def unit_price(self, user_id: int, pid: str, prices: Mapping[str, int]) -> int:
+        if pid not in prices: return 0
+        own = self.partner_prices.get(user_id)
+        if own and pid in own:
+            return own[pid]
+        return prices[pid]
+
+    def _entry(self, user_id: int, cart: Mapping[str, int], version: int) -> Optional[list]:
+        entry = self.subtotals.get(user_id)
+        if entry is None or entry[0] is not cart or entry[1] != version: return None
+        self.subtotals.move_to_end(user_id)
+        return entry
+
+    def subtotal(self, user_id: int, cart: Mapping[str, int], prices: Mapping[str, int], version: int) -> int:
+        entry = self._entry(user_id, cart, version)
+        if entry is None:
+            self.recomputed += 1
+            entry = [cart, version, sum(self.unit_price(user_id, pid, prices) * qty for pid, qty in cart.items())]
+            self.subtotals[user_id] = entry
+            if len(self.subtotals) > self.max_tracked:
+                self.subtotals.popitem(last=False)
+        return entry[2]
+
+    def changed(self, user_id: int, cart: Mapping[str, int], prices: Mapping[str, int], version: int,
+                pid: str, old_qty: int, new_qty: int):
+        """Поправка суммы после изменения количества pid в корзине cart."""
+        entry = self._entry(user_id, cart, version)
+        if entry is not None:
+            entry[2] += self.unit_price(user_id, pid, prices) * (new_qty - old_qty)
+
+    def forget(self, user_id: int):
+        self.subtotals.pop(user_id, None)
+
+    def quote(self, subtotal: int) -> Quote:
+        i = bisect_right(self.thresholds, subtotal)
+        percent = self.tiers[i - 1].percent if i else 0
+        discount = subtotal * percent // 100
+        next_tier = self.tiers[i] if i < len(self.tiers) else None
+        return Quote(subtotal, percent, discount, subtotal - discount, next_tier,
+                     next_tier.threshold - subtotal if next_tier else 0)
@@ -0,0 +1,201 @@
+"""Отчёты о продажах по журналу заказов и сводка новых заказов для администратора.
+
+SalesAggregator держит агрегаты по дням (заказы, выручка, товары) и байтовое
+смещение в журнале, до которого они посчитаны. Каждый отчёт дочитывает только
+записи, добавленные после прошлого раза; агрегаты вместе со смещением
+сохраняются в checkpoint-файл, поэтому после перезапуска журнал тоже не
+перечитывается с начала.
+
+OrderDigest копит новые заказы и раз в interval секунд отправляет одно
+сообщение со сводкой вместо сообщения на каждый заказ. Без фоновой задачи
+(облачная функция) сводку отправляет flush_if_due на следующем апдейте.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from journal import Order, read_orders_since
+
+# День: {"orders": n, "revenue": ₽, "items": шт., "skus": {id: [шт., ₽]}}
+DayStats = Dict[str, Any]
+# Меняется вместе с тем, как считаются агрегаты: checkpoint другой версии пересчитывается
+CHECKPOINT_VERSION = 2
+
+
+class Summary(NamedTuple):
+    orders: int
+    revenue: int
+    items: int
+    # (id, шт., ₽) по убыванию выручки
+    top: List[Tuple[str, int, int]]
+
+    @property
+    def avg_check(self) -> int:
+        return self.revenue // self.orders if self.orders else 0
+
+    @property
+    def avg_items(self) -> float:
+        return self.items / self.orders if self.orders else 0.0
+
+
+def _new_day() -> DayStats:
+    return {"orders": 0, "revenue": 0, "items": 0, "skus": {}}
+
+
+class SalesAggregator:
+    def __init__(self, journal_path: str, checkpoint_path: str, utc_offset_hours: float = 3):
+        self.journal_path = journal_path
+        self.checkpoint_path = checkpoint_path
+        self.tz = timezone(timedelta(hours=utc_offset_hours))
+        self.offset = 0
+        self.inode = 0
+        self.days: Dict[str, DayStats] = {}
+        self.names: Dict[str, str] = {}
+        self.lock: Optional[asyncio.Lock] = None
+        self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") != CHECKPOINT_VERSION:
+                logging.info(f"Sales checkpoint {self.checkpoint_path} is outdated, recounting")
+                return
+            self.offset, self.inode = state["offset"], state["inode"]
+            self.days, self.names = state["days"], state["names"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Sales checkpoint {self.checkpoint_path} is unreadable, recounting: {e}")
+
+    def _save_checkpoint(self, state: str):
+        tmp = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(state)
+        os.replace(tmp, self.checkpoint_path)
+
+    def day_of(self, ts: int) -> str:
+        return datetime.fromtimestamp(ts, self.tz).date().isoformat()
+
+    def today(self) -> date:
+        return datetime.now(self.tz).date()
+
+    def add(self, order: Order):
+        key = self.day_of(order.get("ts", 0))
+        day = self.days.get(key)
+        if day is None:
+            day = self.days[key] = _new_day()
+        day["orders"] += 1
+        total = order.get("total", 0)
+        day["revenue"] += total
+        # Скидка ступени распределяется по строкам, чтобы выручка товаров сходилась с выручкой дня
+        subtotal = order.get("subtotal")
+        share = total / subtotal if subtotal else 1
+        for it in order.get("items", ()):
+            qty, pid = it["qty"], it["id"]
+            day["items"] += qty
+            sku = day["skus"].get(pid)
+            if sku is None:
+                sku = day["skus"][pid] = [0, 0]
+            sku[0] += qty
+            sku[1] += round(qty * it["price"] * share)
+            self.names[pid] = it["name"]
+
+    async def refresh(self) -> int:
+        """Дочитывает новые записи журнала. Возвращает их число."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            try:
+                st = os.stat(self.journal_path)
+            except FileNotFoundError:
+                return 0
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # Журнал заменён или усечён — считаем заново
+                if self.offset:
+                    logging.warning(f"Order journal {self.journal_path} was replaced, recounting sales")
+                self.offset, self.inode, self.days, self.names = 0, st.st_ino, {}, {}
+            added = 0
+            async for offset, order in read_orders_since(self.journal_path, self.offset):
+                self.add(order)
+                self.offset = offset
+                added += 1
+            if added:
+                state = json.dumps({"version": CHECKPOINT_VERSION, "offset": self.offset, "inode": self.inode,
+                                    "days": self.days, "names": self.names}, ensure_ascii=False)
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self._save_checkpoint, state)
+                except OSError as e:
+                    logging.warning(f"Failed to save sales checkpoint {self.checkpoint_path}: {e}")
+            return added
+
+    def summary(self, first: Optional[date] = None, last: Optional[date] = None, top: int = 10) -> Summary:
+        """Сводка за дни с first по last включительно (None — без границы)."""
+        lo = first.isoformat() if first else ""
+        hi = last.isoformat() if last else "9999"
+        orders = revenue = items = 0
+        skus: Dict[str, List[int]] = {}
+        for day, stats in self.days.items():
+            if not lo <= day <= hi: continue
+            orders += stats["orders"]
+            revenue += stats["revenue"]
+            items += stats["items"]
+            for pid, (qty, rev) in stats["skus"].items():
+                acc = skus.get(pid)
+                if acc is None:
+                    acc = skus[pid] = [0, 0]
+                acc[0] += qty
+                acc[1] += rev
+        ranked = sorted(skus.items(), key=lambda kv: -kv[1][1])[:top]
+        return Summary(orders, revenue, items, [(pid, qty, rev) for pid, (qty, rev) in ranked])
+
+
+class OrderDigest:
+    """Копит заказы и отправляет их сводкой раз в interval секунд."""
+
+    def __init__(self, interval: float, send: Callable[[List[Order]], Awaitable[None]]):
+        self.interval = interval
+        self.send = send
+        self.pending: List[Order] = []
+        self.task: Optional[asyncio.Task] = None
+        self.sent_at: Optional[float] = None
+
+    def add(self, order: Order):
+        self.pending.append(order)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Order digest failed")
+
+    async def flush(self):
+        if not self.pending: return
+        batch, self.pending = self.pending, []
+        try:
+            await self.send(batch)
+        except Exception:
+            self.pending[:0] = batch
+            raise
+        self.sent_at = time.monotonic()
+
+    async def flush_if_due(self):
+        """Отправляет сводку, если с прошлой прошло не меньше interval секунд."""
+        if self.sent_at is None or time.monotonic() - self.sent_at >= self.interval:
+            await self.flush()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
@@ -0,0 +1,223 @@
+"""Планировщик исходящих запросов к Bot API.
+
+Ограничивает частоту отправки общим token bucket (~30 сообщений/с на бота) и
+bucket'ом на каждый чат, пропускает запросы в порядке приоритета и повторяет
+их после 429 с учётом retry_after. Подключается к сессии бота как request
+middleware, поэтому обработчики продолжают вызывать message.answer и т.п. как раньше.
+
+При переполненной очереди запрос вытесняет самый новый из менее важных, поэтому
+уведомления и подтверждения заказов не теряются из-за очереди просмотра.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, AnswerInlineQuery
+
+# Классы приоритета: меньше — важнее
+ALERT = 0    # уведомления администратору
+ORDER = 1    # подтверждения заказов
+BROWSE = 2   # просмотр каталога и корзины
+PRIORITIES = (ALERT, ORDER, BROWSE)
+
+# Приоритет запросов текущего обработчика; не задан — ALERT для чата администратора, иначе BROWSE
+send_priority: ContextVar[Optional[int]] = ContextVar("send_priority", default=None)
+
+# Ответы на callback/inline-запросы не считаются сообщениями и не ограничиваются
+UNLIMITED_METHODS = (AnswerCallbackQuery, AnswerInlineQuery)
+
+MAX_TRACKED_CHATS = 10000
+
+
+class SchedulerOverloaded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — уже доступен)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Pending:
+    __slots__ = ("chat_id", "future", "enqueued")
+
+    def __init__(self, chat_id, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class SendScheduler:
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_queue: int = 1000, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats: Dict[object, TokenBucket] = {}
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.queues: List[Deque[Pending]] = [deque() for _ in PRIORITIES]
+        self.depth = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        # Метрики
+        self.max_depth = 0
+        self.granted = 0
+        self.rejected = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _chat(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= MAX_TRACKED_CHATS:
+                self._prune_chats()
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_chats(self):
+        # Полный и не заблокированный bucket ничем не отличается от нового
+        now = time.monotonic()
+        waiting = {p.chat_id for queue in self.queues for p in queue}
+        for chat_id, bucket in list(self.chats.items()):
+            if chat_id not in waiting and bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                del self.chats[chat_id]
+
+    async def acquire(self, chat_id, priority: int = BROWSE):
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        if self.depth >= self.max_queue and not self._shed(priority):
+            self.rejected += 1
+            raise SchedulerOverloaded(f"Send queue is full ({self.depth} pending)")
+        pending = Pending(chat_id, asyncio.get_running_loop().create_future())
+        self.queues[priority].append(pending)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self.wakeup.set()
+        try:
+            await pending.future
+        except asyncio.CancelledError:
+            if not pending.future.done():
+                self.queues[priority].remove(pending)
+                self.depth -= 1
+            raise
+
+    def _shed(self, priority: int) -> bool:
+        """Отказывает самому новому запросу с приоритетом ниже priority, освобождая место."""
+        for queue in reversed(self.queues[priority + 1:]):
+            if queue:
+                pending = queue.pop()
+                self.depth -= 1
+                self.rejected += 1
+                pending.future.set_exception(SchedulerOverloaded(f"Send queue is full, shed for priority {priority}"))
+                return True
+        return False
+
+    def _grant(self, queue: Deque[Pending], pending: Pending, now: float):
+        queue.remove(pending)
+        self.depth -= 1
+        self.global_bucket.take()
+        self._chat(pending.chat_id).take()
+        waited = now - pending.enqueued
+        self.granted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        pending.future.set_result(None)
+
+    def _next_delay(self) -> Optional[float]:
+        """Выдаёт все разрешения, которые можно выдать сейчас; возвращает время до следующей попытки."""
+        while True:
+            now = time.monotonic()
+            if not self.depth:
+                return None
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                return global_delay
+            soonest = None
+            for queue in self.queues:
+                for pending in queue:
+                    delay = self._chat(pending.chat_id).delay(now)
+                    if delay == 0:
+                        break
+                    soonest = delay if soonest is None else min(soonest, delay)
+                else:
+                    continue
+                self._grant(queue, pending, now)
+                break
+            else:
+                return soonest
+
+    async def _run(self):
+        while True:
+            delay = self._next_delay()
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def retry_after(self, chat_id, seconds: float):
+        self.retries += 1
+        self._chat(chat_id).block(seconds)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.depth,
+            "queue_depth_max": self.max_depth,
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+            "chats_tracked": len(self.chats),
+        }
+
+
+class SchedulerMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler: SendScheduler, alert_chat_id=None):
+        self.scheduler = scheduler
+        self.alert_chat_id = alert_chat_id
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or isinstance(method, UNLIMITED_METHODS):
+            return await make_request(bot, method)
+        priority = send_priority.get()
+        if priority is None:
+            priority = ALERT if chat_id == self.alert_chat_id else BROWSE
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.scheduler.retry_after(chat_id, e.retry_after)
+                if attempt > self.scheduler.max_retries:
+                    raise
+                logging.warning(f"Flood control on {type(method).__name__} to {chat_id}, retry in {e.retry_after}s")
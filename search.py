@@ -0,0 +1,119 @@
+"""Поиск товаров по названию, описанию и объёму.
+
+Инвертированный индекс по нормализованным основам слов (нижний регистр, ё→е,
+отсечение типичных русских окончаний). Слово запроса сопоставляется с основами
+по префиксу (бинарный поиск в отсортированном словаре), а если префиксных
+совпадений нет — по похожести триграмм, чтобы прощать опечатки.
+"""
+import heapq
+import re
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Mapping, Set, Tuple
+
+WORD_RE = re.compile(r"\w+")
+
+# Окончания, от длинных к коротким
+ENDINGS = (
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ов", "ев", "ам", "ям",
+    "ах", "ях", "ом", "ем", "ую", "юю", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+)
+MIN_STEM = 3
+# Служебные слова не индексируются и игнорируются в запросе
+STOP_WORDS = frozenset(("и", "в", "во", "с", "со", "к", "ко", "на", "для", "от", "по", "из", "без", "при", "или"))
+
+# Вес совпадения по полю товара
+FIELD_WEIGHTS = (("name", 3.0), ("volume", 1.0), ("desc", 1.0))
+EXACT_BONUS = 1.0
+PREFIX_EXPANSION_LIMIT = 64
+FUZZY_THRESHOLD = 0.5
+# Результаты по отдельным словам кэшируются: inline-запросы приходят по мере набора текста
+WORD_CACHE_SIZE = 4096
+
+
+def normalize(text: str) -> List[str]:
+    return [w for w in WORD_RE.findall(text.lower().replace("ё", "е")) if w not in STOP_WORDS]
+
+
+def stem(word: str) -> str:
+    if word.isdigit(): return word
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def same_text(a: Mapping[str, str], b: Mapping[str, str]) -> bool:
+    """Индексируются ли товары a и b одинаково (совпадают все поля поиска)."""
+    return all(a.get(field) == b.get(field) for field, _ in FIELD_WEIGHTS)
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    def __init__(self, products: Mapping[str, Mapping[str, str]]):
+        self.postings: Dict[str, Dict[str, float]] = {}
+        for pid, product in products.items():
+            for field, weight in FIELD_WEIGHTS:
+                for word in normalize(product.get(field, "")):
+                    doc = self.postings.setdefault(stem(word), {})
+                    doc[pid] = max(doc.get(pid, 0.0), weight)
+        self.terms = sorted(self.postings)
+        self.by_trigram: Dict[str, List[str]] = {}
+        for term in self.terms:
+            if term.isdigit(): continue
+            for gram in trigrams(term):
+                self.by_trigram.setdefault(gram, []).append(term)
+        self.word_cache: Dict[str, Dict[str, float]] = {}
+
+    def _prefix_terms(self, prefix: str) -> Iterable[str]:
+        i = bisect_left(self.terms, prefix)
+        for term in self.terms[i:i + PREFIX_EXPANSION_LIMIT]:
+            if not term.startswith(prefix): break
+            yield term
+
+    def _fuzzy_terms(self, term: str) -> Iterable[Tuple[str, float]]:
+        grams = trigrams(term)
+        shared = Counter(t for gram in grams for t in self.by_trigram.get(gram, ()))
+        for candidate, count in shared.items():
+            similarity = 2 * count / (len(grams) + len(candidate))
+            if similarity >= FUZZY_THRESHOLD:
+                yield candidate, similarity
+
+    def _match_word(self, word: str) -> Dict[str, float]:
+        scores = self.word_cache.get(word)
+        if scores is None:
+            if len(self.word_cache) >= WORD_CACHE_SIZE:
+                self.word_cache.clear()
+            scores = self.word_cache[word] = self._score_word(word)
+        return scores
+
+    def _score_word(self, word: str) -> Dict[str, float]:
+        query = stem(word)
+        scores: Dict[str, float] = {}
+        for term in self._prefix_terms(query):
+            # Полное совпадение основы важнее продолжения префикса
+            bonus = EXACT_BONUS if term == query else len(query) / len(term)
+            for pid, weight in self.postings[term].items():
+                scores[pid] = max(scores.get(pid, 0.0), weight + bonus)
+        if scores or len(query) < MIN_STEM or query.isdigit():
+            return scores
+        for term, similarity in self._fuzzy_terms(query):
+            for pid, weight in self.postings[term].items():
+                scores[pid] = max(scores.get(pid, 0.0), weight * similarity)
+        return scores
+
+    def search(self, query: str, limit: int = 20) -> List[str]:
+        """Возвращает id товаров, в которых нашлись все слова запроса, от лучших к худшим."""
+        matches = sorted((self._match_word(word) for word in set(normalize(query))), key=len)
+        if not matches or not matches[0]: return []
+        # Пересечение начинаем с самого короткого списка
+        total = dict(matches[0])
+        for scores in matches[1:]:
+            total = {pid: score + scores[pid] for pid, score in total.items() if pid in scores}
+            if not total: return []
+        return heapq.nlargest(limit, total, key=total.__getitem__)
@@ -0,0 +1,308 @@
+"""Хранилища корзин и флагов ожидания телефона.
+
+Корзина — словарь {id товара: количество}. Состояние пользователя вытесняется,
+если он не появлялся дольше ttl секунд или пользователей больше max_users
+(первыми уходят давно неактивные). Если при этом теряется непустая корзина,
+вызывается on_abandoned(uid, cart).
+
+MemoryStorage держит всё в памяти процесса. SQLiteStorage дополнительно сохраняет
+состояние в SQLite (WAL) отложенной пакетной записью: изменения копятся в памяти
+и сбрасываются одной транзакцией раз в flush_interval секунд.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set
+
+Cart = Dict[str, int]
+AbandonedHook = Callable[[int, Cart], None]
+
+ABSENT_CACHE_SIZE = 100000
+
+
+class MemoryStorage:
+    def __init__(self, max_users: int = 0, ttl: float = 0, sweep_interval: float = 60):
+        self.carts: Dict[int, Cart] = {}
+        self.waiting_for_phone: Set[int] = set()
+        self.max_users = max_users
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.on_abandoned: Optional[AbandonedHook] = None
+        # Пользователи с непустым состоянием, от давно неактивных к недавним
+        self.seen: "OrderedDict[int, float]" = OrderedDict()
+        self.evicted = 0
+        self.sweeper: Optional[asyncio.Task] = None
+        self.swept_at = time.monotonic()
+
+    def _touch(self, uid: int):
+        if uid in self.carts or uid in self.waiting_for_phone:
+            self.seen[uid] = time.monotonic()
+            self.seen.move_to_end(uid)
+            while self.max_users and len(self.seen) > self.max_users:
+                if not self._evict_lru(): break
+        else:
+            self.seen.pop(uid, None)
+
+    def _evict_lru(self) -> bool:
+        self._evict(next(iter(self.seen)))
+        return True
+
+    def _evict(self, uid: int):
+        cart = self.carts.pop(uid, None)
+        self.waiting_for_phone.discard(uid)
+        self.seen.pop(uid, None)
+        self.evicted += 1
+        if cart and self.on_abandoned:
+            try:
+                self.on_abandoned(uid, cart)
+            except Exception:
+                logging.exception(f"Abandoned cart hook failed for {uid}")
+
+    def sweep(self) -> int:
+        """Вытесняет пользователей, неактивных дольше ttl. Возвращает их число."""
+        if not self.ttl: return 0
+        self.swept_at = time.monotonic()
+        deadline = self.swept_at - self.ttl
+        expired = []
+        for uid, seen in self.seen.items():
+            if seen > deadline: break
+            expired.append(uid)
+        for uid in expired:
+            self._evict(uid)
+        return len(expired)
+
+    def sweep_if_due(self) -> int:
+        """sweep, если с прошлого прошло sweep_interval секунд — для запуска без фоновой задачи."""
+        if not self.ttl or time.monotonic() - self.swept_at < self.sweep_interval: return 0
+        return self.sweep()
+
+    def get_cart(self, uid: int) -> Cart:
+        cart = self.carts.get(uid)
+        if cart is None: return {}
+        self._touch(uid)
+        return cart
+
+    def put_cart(self, uid: int, cart: Cart):
+        if cart:
+            self.carts[uid] = cart
+        else:
+            self.carts.pop(uid, None)
+        self._touch(uid)
+
+    def is_waiting_for_phone(self, uid: int) -> bool:
+        return uid in self.waiting_for_phone
+
+    def set_waiting_for_phone(self, uid: int, waiting: bool):
+        if waiting:
+            self.waiting_for_phone.add(uid)
+        else:
+            self.waiting_for_phone.discard(uid)
+        self._touch(uid)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Storage sweep failed")
+
+    async def start(self):
+        if self.ttl and self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+            self.sweeper = None
+
+
+class SQLiteStorage(MemoryStorage):
+    """Память процесса как кэш поверх SQLite.
+
+    Строки пользователя читаются при первом обращении, поэтому апдейты одного
+    пользователя должны обрабатываться одним процессом. При переполнении кэша
+    пользователь только выгружается из памяти (строка остаётся в базе),
+    при истечении ttl — удаляется и из базы. Срок для строк считается от
+    последней записи; для выгруженных из памяти пользователей on_abandoned
+    не вызывается. Не выгружаются пользователи с несохранёнными изменениями,
+    с изменениями, которые пишутся прямо сейчас, и только что прочитанный.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, max_users: int = 0, ttl: float = 0,
+                 sweep_interval: float = 60):
+        super().__init__(max_users, ttl, sweep_interval)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id INTEGER PRIMARY KEY,"
+            " cart TEXT NOT NULL,"
+            " waiting_for_phone INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(sessions)")}
+        if "seen_at" not in columns:
+            self.db.execute("ALTER TABLE sessions ADD COLUMN seen_at REAL NOT NULL DEFAULT 0")
+            self.db.execute("UPDATE sessions SET seen_at = ?", (time.time(),))
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_seen_at ON sessions (seen_at)")
+        # Пользователи, у которых точно нет сохранённого состояния (чтобы не ходить в базу повторно)
+        self.absent: "OrderedDict[int, None]" = OrderedDict()
+        self.dirty: Set[int] = set()
+        # Пользователи из пакета, который пишется в базу; до COMMIT их строки в базе ещё старые
+        self.writing: Set[int] = set()
+        self.flushing: Optional[asyncio.Lock] = None
+        self.lock = threading.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    def _load(self, uid: int):
+        if uid in self.seen or uid in self.absent: return
+        with self.lock:
+            row = self.db.execute("SELECT cart, waiting_for_phone FROM sessions WHERE user_id = ?", (uid,)).fetchone()
+        if row:
+            cart = json.loads(row[0])
+            if isinstance(cart, list):
+                # Старый формат: [{"id": ..., "qty": ...}, ...]
+                cart = {it["id"]: it["qty"] for it in cart}
+            if cart:
+                self.carts[uid] = cart
+            if row[1]:
+                self.waiting_for_phone.add(uid)
+            self._touch(uid)
+        if uid not in self.seen:
+            self._mark_absent(uid)
+
+    def _mark_absent(self, uid: int):
+        self.absent[uid] = None
+        if len(self.absent) > ABSENT_CACHE_SIZE:
+            self.absent.popitem(last=False)
+
+    def _touch(self, uid: int):
+        super()._touch(uid)
+        if uid in self.seen:
+            self.absent.pop(uid, None)
+
+    def _evict_lru(self) -> bool:
+        # Несохранённых пользователей не выгружаем — их данные есть только в памяти.
+        # Последний в seen только что прочитан или изменён: выгрузка тут же потеряла бы его
+        newest = next(reversed(self.seen), None)
+        for uid in self.seen:
+            if uid not in self.dirty and uid not in self.writing and uid != newest:
+                self.carts.pop(uid, None)
+                self.waiting_for_phone.discard(uid)
+                self.seen.pop(uid)
+                self.evicted += 1
+                return True
+        return False
+
+    def _evict(self, uid: int):
+        super()._evict(uid)
+        self._mark_absent(uid)
+        self.dirty.add(uid)
+
+    def sweep(self) -> int:
+        expired = super().sweep()
+        if not self.ttl: return expired
+        # Строки пользователей, выгруженных из памяти раньше срока, удаляются прямо в базе
+        deadline = time.time() - self.ttl
+        with self.lock:
+            rows = self.db.execute("SELECT user_id FROM sessions WHERE seen_at < ?", (deadline,)).fetchall()
+            stale = [(uid,) for uid, in rows if uid not in self.seen and uid not in self.dirty]
+            if stale:
+                self.db.executemany("DELETE FROM sessions WHERE user_id = ?", stale)
+        self.evicted += len(stale)
+        return expired + len(stale)
+
+    def get_cart(self, uid: int) -> Cart:
+        self._load(uid)
+        return super().get_cart(uid)
+
+    def put_cart(self, uid: int, cart: Cart):
+        self._load(uid)
+        self.dirty.add(uid)
+        super().put_cart(uid, cart)
+
+    def is_waiting_for_phone(self, uid: int) -> bool:
+        self._load(uid)
+        return super().is_waiting_for_phone(uid)
+
+    def set_waiting_for_phone(self, uid: int, waiting: bool):
+        self._load(uid)
+        self.dirty.add(uid)
+        super().set_waiting_for_phone(uid, waiting)
+
+    async def start(self):
+        await super().start()
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("SQLite storage flush failed")
+
+    async def flush(self):
+        if not self.dirty: return
+        # Пакеты пишутся по очереди, иначе более старый снимок мог бы закоммититься позже нового
+        if self.flushing is None:
+            self.flushing = asyncio.Lock()
+        async with self.flushing:
+            if not self.dirty: return
+            # Снимок берём в потоке event loop, пока состояние не может измениться
+            now = time.time()
+            batch = [(uid, json.dumps(self.carts.get(uid, {})), int(uid in self.waiting_for_phone), now)
+                     for uid in self.dirty]
+            self.writing, self.dirty = self.dirty, set()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            except Exception:
+                self.dirty.update(self.writing)
+                raise
+            finally:
+                self.writing = set()
+
+    def _write(self, batch):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for uid, cart, waiting, seen_at in batch:
+                    if cart == "{}" and not waiting:
+                        self.db.execute("DELETE FROM sessions WHERE user_id = ?", (uid,))
+                    else:
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO sessions (user_id, cart, waiting_for_phone, seen_at) VALUES (?, ?, ?, ?)",
+                            (uid, cart, waiting, seen_at),
+                        )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    async def close(self):
+        await super().close()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        with self.lock:
+            self.db.close()
+
+
+def create_storage(kind: str, path: str, flush_interval: float, max_users: int = 0, ttl: float = 0) -> MemoryStorage:
+    if kind == "sqlite":
+        return SQLiteStorage(path, flush_interval, max_users, ttl)
+    if kind == "memory":
+        return MemoryStorage(max_users, ttl)
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,19 @@
+import callbacks as cbd
+
+
+def test_product_id_round_trip():
+    data = cbd.encode(cbd.ADD, "foam_collagen_mint")
+    assert cbd.decode(data) == cbd.CallbackAction(cbd.ADD, "foam_collagen_mint")
+    assert cbd.decode(cbd.encode(cbd.CHECKOUT)) == cbd.CallbackAction(cbd.CHECKOUT)
+
+
+def test_category_code_does_not_depend_on_catalog():
+    # Код считается только из названия — одинаков в любом процессе и версии каталога
+    assert cbd.category_code("Очищение") == cbd.category_code("Очищение")
+    assert cbd.category_code("Очищение") != cbd.category_code("Тоники")
+    assert len(cbd.encode(cbd.CATEGORY, cbd.category_code("Очищение")).encode()) <= 64
+
+
+def test_positional_buttons_are_rejected():
+    # Кнопки версии 1 несли номер товара в каталоге, который мог указывать уже на другой товар
+    assert cbd.decode("1a12") is None
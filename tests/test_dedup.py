@@ -0,0 +1,35 @@
+from dedup import CheckoutTokens, RecentIds
+
+
+def test_checkout_token_consumed_once():
+    tokens = CheckoutTokens()
+    token, age = tokens.issue(1)
+    assert age == 0
+    # Повторное «Оформить» возвращает тот же токен
+    assert tokens.issue(1)[0] == token
+    assert tokens.consume(1) == token
+    assert tokens.consume(1) is None
+    assert tokens.issue(1)[0] != token
+
+
+def test_checkout_tokens_are_per_user_and_expire():
+    tokens = CheckoutTokens(ttl=0)
+    tokens.issue(1)
+    assert tokens.consume(1) is None
+    tokens = CheckoutTokens(max_size=2)
+    tokens.issue(1)
+    tokens.issue(2)
+    tokens.issue(3)
+    assert tokens.consume(1) is None
+    assert tokens.consume(2) is not None and tokens.consume(3) is not None
+
+
+def test_recent_ids_report_duplicates():
+    ids = RecentIds(max_size=2)
+    assert not ids.seen(1)
+    assert ids.seen(1)
+    ids.seen(2)
+    ids.seen(3)
+    # Вытеснен самый старый id
+    assert not ids.seen(1)
+    assert ids.duplicates == 1
@@ -0,0 +1,49 @@
+import random
+
+from pricing import Pricing, Tier
+
+
+PRICES = {f"p{i}": 100 * (i + 1) for i in range(20)}
+
+
+def full_sum(pricing, uid, cart):
+    return sum(pricing.unit_price(uid, pid, PRICES) * qty for pid, qty in cart.items())
+
+
+def test_running_subtotal_matches_full_recount():
+    # Партнёр 1 со своими ценами; маленький max_tracked, чтобы записи вытеснялись
+    pricing = Pricing([Tier(5000, 10)], {1: {"p0": 1, "p3": 7}}, max_tracked=3)
+    rnd = random.Random(0)
+    carts = {uid: {} for uid in range(1, 6)}
+    for _ in range(20000):
+        uid = rnd.choice(list(carts))
+        cart = carts[uid]
+        pid = rnd.choice(list(PRICES))
+        old = cart.get(pid, 0)
+        op = rnd.random()
+        new = 0 if op < 0.2 else old + 1 if op < 0.7 else rnd.randint(1, 5)
+        if new:
+            cart[pid] = new
+        else:
+            cart.pop(pid, None)
+        pricing.changed(uid, cart, PRICES, 0, pid, old, new)
+        assert pricing.subtotal(uid, cart, PRICES, 0) == full_sum(pricing, uid, cart)
+
+
+def test_subtotal_recomputed_for_new_cart_object_and_catalog_version():
+    pricing = Pricing()
+    cart = {"p0": 2}
+    assert pricing.subtotal(1, cart, PRICES, 0) == 200
+    # Корзина заново загружена из хранилища — прежняя сумма к ней не относится
+    assert pricing.subtotal(1, {"p0": 3}, PRICES, 0) == 300
+    assert pricing.subtotal(1, cart, {"p0": 50}, 1) == 100
+    assert pricing.recomputed == 3
+
+
+def test_quote_tiers():
+    pricing = Pricing([Tier(1000, 10), Tier(2000, 20)])
+    quote = pricing.quote(1500)
+    assert (quote.percent, quote.discount, quote.total) == (10, 150, 1350)
+    assert quote.next_tier == Tier(2000, 20) and quote.to_next_tier == 500
+    assert pricing.quote(999).percent == 0
+    assert pricing.quote(2500).next_tier is None
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+from storage import MemoryStorage, SQLiteStorage
+
+
+def test_memory_lru_evicts_oldest_and_reports_abandoned():
+    storage = MemoryStorage(max_users=2)
+    abandoned = []
+    storage.on_abandoned = lambda uid, cart: abandoned.append(uid)
+    storage.put_cart(1, {"x": 1})
+    storage.put_cart(2, {"x": 2})
+    storage.get_cart(1)
+    storage.put_cart(3, {"x": 3})
+    assert abandoned == [2]
+    assert storage.get_cart(1) == {"x": 1} and storage.get_cart(2) == {}
+
+
+def test_user_being_written_is_not_evicted(tmp_path):
+    async def run():
+        storage = SQLiteStorage(str(tmp_path / "carts.db"), max_users=2)
+        # Запись в базу «зависает», пока тест её не отпустит
+        release = threading.Event()
+        write = storage._write
+        storage._write = lambda batch: (release.wait(5), write(batch))
+        storage.put_cart(10, {"x": 5})
+        flush = asyncio.ensure_future(storage.flush())
+        await asyncio.sleep(0.05)
+        storage.put_cart(11, {"y": 1})
+        storage.put_cart(12, {"z": 1})
+        assert storage.get_cart(10) == {"x": 5}
+        release.set()
+        await flush
+        await storage.close()
+        reopened = SQLiteStorage(str(tmp_path / "carts.db"))
+        assert reopened.get_cart(10) == {"x": 5}
+        await reopened.close()
+
+    asyncio.run(run())
+
+
+def test_loaded_user_is_not_evicted_at_once(tmp_path):
+    async def run():
+        path = str(tmp_path / "carts.db")
+        storage = SQLiteStorage(path)
+        storage.put_cart(10, {"x": 5})
+        await storage.close()
+        storage = SQLiteStorage(path, max_users=1)
+        # Все остальные пользователи в памяти не сохранены — выгрузить можно было бы только 10
+        storage.put_cart(11, {"y": 1})
+        assert storage.get_cart(10) == {"x": 5}
+        storage.put_cart(10, {"x": 6})
+        await storage.close()
+        storage = SQLiteStorage(path)
+        assert storage.get_cart(10) == {"x": 6} and storage.get_cart(11) == {"y": 1}
+        await storage.close()
+
+    asyncio.run(run())